@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django
+
+django.setup()
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    from xyz_util import mongoutils
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongoutils, 'LOADER', lambda server, db, timeout, **kwargs: client[db])
+    for c in [mongoutils.COUNT_CACHE, mongoutils.SCHEMA_CACHE, mongoutils.QUERY_SHAPES]:
+        c.clear()
+    yield client
+    client.close()
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', help='run the benchmarks marked with @pytest.mark.benchmark')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing comparison, only runs with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='needs --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def bench(capsys):
+    """
+    bench(label, func, number=1, repeat=3): best of repeat runs, printed as seconds per call
+    """
+    import timeit
+
+    def run(label, func, number=1, repeat=3):
+        t = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        with capsys.disabled():
+            print('\n%-50s %12.6fs' % (label, t))
+        return t
+
+    return run
@@ -0,0 +1,10 @@
+SECRET_KEY = 'tests'
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'rest_framework',
+]
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+MONGODB = {'DB': 'xyz_util_tests'}
+USE_TZ = False
+ALLOWED_HOSTS = ['testserver']
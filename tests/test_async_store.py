@@ -0,0 +1,81 @@
+import asyncio
+import gc
+
+import pytest
+
+from xyz_util import mongoutils
+from xyz_util.mongoutils import AsyncStore, SEARCH_TOKENS_FIELD
+
+mongomock_motor = pytest.importorskip('mongomock_motor')
+
+
+class Articles(AsyncStore):
+    name = 'articles'
+    search_fields = ['title']
+    random_field = '_rand'
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db():
+    mongoutils.SCHEMA_CACHE.clear()
+    return mongomock_motor.AsyncMongoMockClient()['tests']
+
+
+def test_async_store_has_no_sync_io_methods():
+    for m in ['profile', 'keyset_find', 'export', 'aggregate', 'get_many']:
+        assert not hasattr(AsyncStore, m)
+
+
+def test_async_writes_and_search(db):
+    async def main():
+        await db.articles.create_index([(SEARCH_TOKENS_FIELD, 1)])
+        s = Articles(database=db)
+        await s.upsert({'id': 1}, {'title': '异步存储'})
+        await s.inc({'id': 1}, {'views': 2})
+        await s.add_to_set({'id': 1}, {'tags': 'a'})
+        d = await s.get({'id': 1})
+        assert d['views'] == 2 and d['tags'] == ['a'] and '_rand' in d and d[SEARCH_TOKENS_FIELD]
+        assert [a['id'] async for a in s.find({'search': '存储'})] == [1]
+        assert await s.count({'search': '存储'}) == 1
+        assert await s.sum('views') == 2
+        d = await s.get_or_create({'id': 2}, {'title': 'b'})
+        assert d['title'] == 'b' and '_rand' in d
+        await s.inc({'id': 3}, {'views': 1})
+        await s.add_to_set({'id': 4}, {'tags': 'a'})
+        assert all(['_rand' in a async for a in s.find({'id': {'$in': [3, 4]}})])
+    run(main())
+
+
+class Notes(AsyncStore):
+    name = 'notes'
+    search_fields = ['title', 'body']
+
+
+def test_async_update_refreshes_documents_that_no_longer_match(db):
+    async def main():
+        await db.notes.create_index([(SEARCH_TOKENS_FIELD, 1)])
+        s = Notes(database=db)
+        await s.upsert({'id': 1}, {'title': 'old', 'body': 'text'})
+        await s.update({'title': 'old'}, {'title': 'newword'})
+        assert [a['id'] async for a in s.find({'search': 'newword'})] == [1]
+        assert [a['id'] async for a in s.find({'search': 'text'})] == [1]
+    run(main())
+
+
+def test_async_clients_are_released_with_their_loop():
+    pytest.importorskip('pymongo', minversion='4.9')
+
+    async def main():
+        a = mongoutils.get_async_mongo_client()
+        assert mongoutils.get_async_mongo_client() is a
+        await mongoutils.close_async_mongo_clients()
+
+    for i in range(3):
+        run(main())
+    gc.collect()
+    assert len(mongoutils.ASYNC_CLIENTS) == 0
+    assert not [k for k in mongoutils.CLIENTS if k[0] == 'async']
@@ -0,0 +1,51 @@
+import pytest
+import pymongo
+
+from xyz_util import mongoutils
+from xyz_util.mongoutils import Store, get_mongo_client, close_mongo_clients
+
+SERVER = 'mongodb://127.0.0.1:1'
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    monkeypatch.setattr(mongoutils, 'CLIENTS', {})
+    yield mongoutils.CLIENTS
+    close_mongo_clients()
+
+
+def test_client_reused_per_key(clients):
+    a = get_mongo_client(SERVER, 100)
+    assert get_mongo_client(SERVER, 100) is a
+    assert get_mongo_client(SERVER, 200) is not a
+    assert get_mongo_client(SERVER, 100, maxPoolSize=5) is get_mongo_client(SERVER, 100, maxPoolSize=5) is not a
+    assert len(clients) == 3
+
+
+def test_stores_share_client(clients):
+    a, b = Store(server=SERVER, name='a'), Store(server=SERVER, db='other', name='b')
+    assert a.db.client is b.db.client
+    assert len(clients) == 1
+
+
+def test_client_recreated_after_fork(clients, monkeypatch):
+    a = get_mongo_client(SERVER, 100)
+    monkeypatch.setattr(mongoutils.os, 'getpid', lambda: -1)
+    b = get_mongo_client(SERVER, 100)
+    assert b is not a and clients == {(SERVER, 100, ()): b}
+    a.close()
+
+
+@pytest.mark.benchmark
+def test_benchmark_store_construction(bench, clients):
+    n = 200
+
+    def per_store():
+        for i in range(n):
+            c = pymongo.MongoClient(SERVER, serverSelectionTimeoutMS=100)
+            getattr(c, 'test').users
+            c.close()
+
+    old = bench('new MongoClient per Store x%d' % n, per_store)
+    new = bench('shared client Store() x%d' % n, lambda: [Store(server=SERVER, name='users') for i in range(n)])
+    assert new < old
@@ -0,0 +1,123 @@
+import pytest
+
+from xyz_util.datautils import HyperLogLog, Accessor, access, compile_accessor
+
+
+def test_hyperloglog_estimate_and_merge():
+    a, b = HyperLogLog(12), HyperLogLog(12)
+    a.update(range(0, 60000))
+    b.update(range(40000, 100000))
+    assert abs(a.count() - 60000) / 60000.0 < 0.05
+    assert abs(len(a.merge(b)) - 100000) / 100000.0 < 0.05
+    assert HyperLogLog(12, a.registers).count() == a.count()
+
+
+def test_hyperloglog_counts_equal_numbers_once():
+    from decimal import Decimal
+    from bson import Int64, Decimal128
+    h = HyperLogLog(12)
+    h.update([5, Int64(5), 5.0, Decimal128('5'), Decimal('5.0')])
+    assert h.count() == 1
+    h.update([True, 5.5, '5'])
+    assert h.count() == 4
+
+
+class LegacyAccessor(str):
+    """
+    Accessor.resolve before compiled paths, kept as the reference behaviour
+    """
+
+    def resolve(self, context, safe=True, quiet=False):
+        try:
+            current = context
+            for bit in (self.split('.') if self else ()):
+                try:
+                    current = current[bit]
+                except (TypeError, AttributeError, KeyError):
+                    try:
+                        current = getattr(current, bit)
+                    except (TypeError, AttributeError):
+                        try:
+                            current = current[int(bit)]
+                        except (IndexError, ValueError, KeyError, TypeError):
+                            raise ValueError('Failed lookup for key [%s] in %r, when resolving the accessor %s'
+                                             % (bit, current, self))
+                if callable(current):
+                    if safe and getattr(current, 'alters_data', False):
+                        raise ValueError('refusing to call %s() because `.alters_data = True`' % repr(current))
+                    if not getattr(current, 'do_not_call_in_templates', False):
+                        current = current()
+                if current is None:
+                    break
+            return current
+        except:
+            if not quiet:
+                raise
+
+
+class Obj(object):
+    x = {'y': [1, 2]}
+    items = 'attr'
+
+    def method(self):
+        return 'called'
+
+    def save(self):
+        pass
+
+    save.alters_data = True
+
+
+class Mapping(dict):
+    pass
+
+
+CONTEXTS = [{'a': {'b': 1}}, {'a': {}}, {'a': Obj()}, {'a': [{'b': 3}]}, Obj(), 'brad', [1, [2, 3]],
+            {'a': None}, {'a': {'items': 1}}, {'a': Mapping(items=2)}, {'a': Mapping()}, {'0': 'k'}, {0: 'z'}]
+PATHS = ['a.b', 'a.x.y.1', 'method', 'save', '__len__', '0.upper', '1.0', 'a.items', '0', 'a', 'x.y.5', '']
+
+
+def outcome(accessor, context, quiet):
+    try:
+        return repr(accessor.resolve(context, quiet=quiet))
+    except Exception as e:
+        return type(e).__name__
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_accessor_matches_legacy_resolve(path):
+    a, legacy = Accessor(path), LegacyAccessor(path)
+    # twice over, so the second round runs on the cached lookup kinds
+    for context in CONTEXTS * 2:
+        for quiet in (True, False):
+            assert outcome(a, context, quiet) == outcome(legacy, context, quiet)
+
+
+def test_accessor_caches_only_type_level_lookups():
+    a = Accessor('a.items')
+    a.resolve({'a': {'items': 1}})
+    assert a.lookups[(1, dict)] == 'item'
+    # a dict without the key falls back to the attribute, which must not be cached for dict
+    assert list(a.resolve({'a': {}})) == []
+    assert a.lookups[(1, dict)] == 'item'
+    assert a.resolve({'a': {'items': 5}}) == 5
+    b = Accessor('x.y.0')
+    assert b.resolve(Obj()) == 1
+    assert b.lookups[(0, Obj)] == 'attr' and b.lookups[(2, list)] == 'index'
+
+
+def test_resolve_many_and_compiled_cache():
+    rs = [{'a': {'b': i}} for i in range(5)] + [{'a': None}, {}]
+    assert Accessor('a.b').resolve_many(rs, quiet=True) == [0, 1, 2, 3, 4, None, None]
+    assert compile_accessor('a.b') is compile_accessor('a.b')
+    assert access({'a': [{'b': 2}]}, 'a.0.b') == 2
+
+
+@pytest.mark.benchmark
+def test_benchmark_accessor(bench):
+    rs = [{'a': {'b': [i, {'c': i}]}} for i in range(1000000)]
+    legacy = LegacyAccessor('a.b.1.c')
+    old = bench('legacy Accessor.resolve x1M', lambda: [legacy.resolve(r) for r in rs], repeat=1)
+    new = bench('compiled Accessor.resolve_many x1M', lambda: Accessor('a.b.1.c').resolve_many(rs), repeat=1)
+    bench('access() x100k', lambda: [access(r, 'a.b.1.c') for r in rs[:100000]], repeat=1)
+    assert new < old
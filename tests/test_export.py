@@ -0,0 +1,92 @@
+import io
+import json
+
+import pytest
+
+from xyz_util.mongoutils import Store
+
+
+class Orders(Store):
+    name = 'orders'
+    ordering = ('id',)
+
+
+@pytest.fixture
+def orders(mongo):
+    s = Orders()
+    s.collection.insert_many([{'id': 1, 'a': 1}, {'id': 2, 'b': 'x'}, {'id': 3, 'a': 2.5, 'c': {'d': 1}}])
+    return s
+
+
+def test_ndjson_export(orders):
+    out = io.StringIO()
+    assert orders.export(out, batch_size=1)['rows'] == 3
+    assert [json.loads(a)['id'] for a in out.getvalue().splitlines()] == [1, 2, 3]
+
+
+def test_csv_export_keeps_late_columns(orders):
+    out = io.StringIO()
+    orders.export(out, 'csv', columns=['id', 'a', 'b', 'c.d'], batch_size=1)
+    assert out.getvalue().splitlines() == ['id,a,b,c.d', '1,1,,', '2,,x,', '3,2.5,,1']
+
+
+def test_csv_export_needs_columns_and_rejects_unknown_fields(orders):
+    with pytest.raises(ValueError):
+        orders.export(io.StringIO(), 'csv')
+    with pytest.raises(ValueError):
+        orders.export(io.StringIO(), 'csv', projection={'id': 1, 'c': 1, '_id': 0})
+    with pytest.raises(ValueError):
+        orders.export(io.StringIO(), 'csv', columns=['id'], raw=True)
+
+
+def test_parquet_export_uses_schema_types(orders):
+    pq = pytest.importorskip('pyarrow.parquet')
+    orders.__dict__['_fields'] = {'id': 'integer', 'a': 'number', 'b': 'string'}
+    out = io.BytesIO()
+    orders.export(out, 'parquet', columns=['id', 'a', 'b', 'c.d'], batch_size=1)
+    out.seek(0)
+    t = pq.read_table(out)
+    assert str(t.schema.field('a').type) == 'double'
+    assert t.to_pydict() == {'id': [1, 2, 3], 'a': [1.0, None, 2.5], 'b': [None, 'x', None], 'c.d': [None, None, '1']}
+
+
+class Readings(Store):
+    name = 'readings'
+    ordering = ('id',)
+    # mongomock cannot run the $reduce schema profile
+    _fields = {'id': 'integer', 'v': 'number', 'ok': 'boolean', 'at': 'datetime', 'tag': 'string', 'a': 'object',
+               'a.b': 'integer'}
+
+
+@pytest.fixture
+def readings(mongo):
+    import datetime
+    s = Readings()
+    s.collection.insert_many([{'id': i, 'v': i / 2.0, 'ok': i % 2 == 0, 'at': datetime.datetime(2024, 1, i + 1),
+                               'tag': 't%d' % i, 'a': {'b': i}} for i in range(5)] + [{'id': 5}])
+    return s
+
+
+def test_to_dataframe_dtypes_follow_schema(readings):
+    df = readings.to_dataframe(projection={'_id': 0}, sort=[('id', 1)])
+    dtypes = dict(df.dtypes.astype(str))
+    # pandas may pick a coarser datetime unit than ns
+    assert dtypes.pop('at').startswith('datetime64')
+    assert dtypes == {'id': 'Int64', 'v': 'float64', 'ok': 'boolean', 'tag': 'string', 'a.b': 'Int64'}
+    assert df['a.b'].isna().tolist() == [False] * 5 + [True]
+    df = readings.to_dataframe(projection=['id', 'tag'], dtypes={'id': 'float64'})
+    assert list(df.columns) == ['id', 'tag'] and str(df['id'].dtype) == 'float64'
+
+
+def test_to_dataframe_flattens_projected_subdocuments(readings):
+    df = readings.to_dataframe(projection=['id', 'a'], sort=[('id', 1)])
+    assert list(df.columns) == ['id', 'a.b']
+    assert df['a.b'].tolist()[:2] == [0, 1]
+
+
+def test_to_dataframe_chunks(readings):
+    frames = list(readings.to_dataframe(projection=['id', 'a'], chunksize=4, sort=[('id', 1)]))
+    assert [len(df) for df in frames] == [4, 2]
+    assert [list(df.columns) for df in frames] == [['id', 'a.b']] * 2
+    assert frames[1]['id'].tolist() == [4, 5]
+    assert list(readings.to_dataframe({'id': -1}, chunksize=4)) == []
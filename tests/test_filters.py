@@ -0,0 +1,116 @@
+import re
+
+import pytest
+
+from xyz_util.mongoutils import normalize_filter_condition, compile_filter_keys, ensure_list
+
+
+def legacy_normalize_filter_condition(data, field_types={}, fields=None, search_fields=[]):
+    """
+    normalize_filter_condition before the cached key plans, kept as the reference behaviour
+    """
+    d = {}
+    if search_fields:
+        sv = data.get('search')
+        if sv:
+            v = {'$regex': sv}
+            for fn in search_fields:
+                d = {'$or': [d, {fn: v}]} if d else {fn: v}
+
+    mm = {
+        'exists': lambda v: {'$exists': v not in ['0', 'false', False]},
+        'isnull': lambda v: {'$ne' if v in ['0', 'false', ''] else '$eq': None},
+        'regex': lambda v: {'$regex': v},
+        'in': lambda v: {'$in': ensure_list(v)},
+        'nin': lambda v: {'$nin': ensure_list(v)},
+        'all': lambda v: {'$all': ensure_list(v)},
+        'gt': lambda v: {'$gt': v},
+        'lt': lambda v: {'$lt': v},
+        'ne': lambda v: {'$ne': v},
+        'eq': lambda v: {'$eq': v},
+        'size': lambda v: {'$size': v},
+        'gte': lambda v: {'$gte': v},
+        'lte': lambda v: {'$lte': v},
+        'type': lambda v: {'$type': v},
+    }
+    for a in data.keys():
+        if a == 'search':
+            continue
+        v = data[a]
+        ps = a.split('__')
+        if len(ps) > 1:
+            mn = ps[-1]
+            mf = mm.get(mn)
+            if mf:
+                sl = len(mn) + 2
+                a = a[:-sl]
+                a = a.replace('__', '.')
+                is_not = a.endswith('.not')
+                if is_not:
+                    a = a[:-4]
+                if isinstance(v, str):
+                    format_func = field_types.get(a)
+                    if format_func:
+                        v = format_func(v)
+                v = mf(v)
+                if is_not:
+                    v = {'$not': v}
+
+        if fields:
+            ps = re.split(r'__|\.', a)
+            if ps[0] not in fields:
+                continue
+            a = ".".join(ps)
+        a = a.replace('__', '.')
+        format_func = field_types.get(a)
+        expr = format_func(v) if not isinstance(v, dict) and format_func else v
+        if a in d and isinstance(d[a], dict):
+            d[a].update(expr)
+        else:
+            d[a] = expr
+
+    return d
+
+
+FIELD_TYPES = {'age': int, 'user.score': float}
+FIELDS = {'age': 'integer', 'name': 'string', 'user': 'object', 'tags': 'array'}
+QUERIES = [
+    {},
+    {'name': 'a'},
+    {'age': '3'},
+    {'age__gt': '3', 'age__lte': '9'},
+    {'name__not__in': 'a,b', 'age__not__gt': '5'},
+    {'name__regex': '^a', 'name__ne': 'ab'},
+    {'user__score__gte': '1.5', 'user.name': 'x'},
+    {'tags__all': ['a', 'b'], 'tags__size': 2},
+    {'name__isnull': 'false', 'age__exists': '0'},
+    {'unknown__in': 'a,b', 'other': 1},
+    {'search': 'abc', 'name__type': 'string'},
+    {'name__startswith': 'a', 'a__b__c': 1},
+]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('fields', [None, FIELDS])
+def test_cached_plans_match_legacy(query, fields):
+    for i in range(2):
+        assert normalize_filter_condition(query, FIELD_TYPES, fields, ['name']) == \
+            legacy_normalize_filter_condition(query, FIELD_TYPES, fields, ['name'])
+
+
+def test_plans_are_cached_per_key_set():
+    compile_filter_keys.cache_clear()
+    for i in range(10):
+        normalize_filter_condition({'age__gt': i, 'name': 'x'})
+    info = compile_filter_keys.cache_info()
+    assert (info.hits, info.misses) == (9, 1)
+
+
+@pytest.mark.benchmark
+def test_benchmark_normalize_filter(bench):
+    qs = QUERIES * 1000
+    legacy = bench('legacy normalize_filter_condition x%d' % len(qs),
+                   lambda: [legacy_normalize_filter_condition(q, FIELD_TYPES, FIELDS, ['name']) for q in qs])
+    cached = bench('cached-plan normalize_filter_condition x%d' % len(qs),
+                   lambda: [normalize_filter_condition(q, FIELD_TYPES, FIELDS, ['name']) for q in qs])
+    assert cached < legacy
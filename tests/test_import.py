@@ -0,0 +1,20 @@
+import importlib
+
+
+def test_import_modules():
+    for m in ['datautils', 'mongoutils']:
+        importlib.import_module('xyz_util.%s' % m)
+
+
+def test_store_roundtrip(mongo):
+    from xyz_util.mongoutils import Store
+
+    class Users(Store):
+        name = 'users'
+
+    s = Users()
+    s.upsert({'id': 1}, {'name': 'a', 'age': 3})
+    s.upsert({'id': 2}, {'name': 'b', 'age': 5})
+    assert s.count() == 2
+    assert s.get({'id': 2})['name'] == 'b'
+    assert s.sum('age') == 8
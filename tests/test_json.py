@@ -0,0 +1,45 @@
+import datetime
+import json
+
+import pytest
+from bson import json_util, ObjectId, Decimal128
+from django.core.serializers.json import DjangoJSONEncoder
+
+from xyz_util import mongoutils
+from xyz_util.mongoutils import mongo_json_dumps, iter_mongo_json
+
+
+def page(n):
+    now = datetime.datetime(2024, 5, 6, 7, 8, 9, 123456)
+    return [{'_id': ObjectId(), 'name': u'用户%d' % i, 'age': i % 90, 'score': i / 3.0, 'tags': ['a', 'b'],
+             'created': now + datetime.timedelta(minutes=i), 'birth': datetime.datetime(1960, 1, 1),
+             'amount': Decimal128('%d.50' % i), 'profile': {'city': 'gz', 'ok': i % 2 == 0, 'note': None}}
+            for i in range(n)]
+
+
+def reference(data):
+    return json.loads(json.dumps(json_util._json_convert(data), cls=DjangoJSONEncoder))
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_mongo_json_dumps_matches_json_util(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(mongoutils, 'orjson', None)
+    data = {'count': 3, 'results': page(3)}
+    assert json.loads(mongo_json_dumps(data)) == reference(data)
+
+
+def test_iter_mongo_json_streams_valid_document():
+    rs = page(250)
+    s = b''.join(iter_mongo_json({'count': 250}, rs, chunk=100))
+    assert json.loads(s) == reference({'count': 250, 'results': rs})
+    assert json.loads(b''.join(iter_mongo_json({}, []))) == {'results': []}
+
+
+@pytest.mark.benchmark
+def test_benchmark_json_page(bench):
+    data = {'count': 1000, 'results': page(1000)}
+    old = bench('json_util._json_convert + json.dumps, 1000 docs',
+                lambda: json.dumps(json_util._json_convert(data), cls=DjangoJSONEncoder).encode('utf8'), number=10)
+    new = bench('mongo_json_dumps, 1000 docs', lambda: mongo_json_dumps(data), number=10)
+    assert new < old
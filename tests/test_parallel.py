@@ -0,0 +1,51 @@
+import pytest
+
+from xyz_util.mongoutils import Store
+
+
+class Events(Store):
+    name = 'events'
+
+
+@pytest.fixture
+def events(mongo):
+    s = Events(db='analytics')
+    s.collection.insert_many([{'n': i, 'kind': 'ab'[i % 2]} for i in range(100)] + [{'kind': 'a'}, {'n': None}])
+    return s
+
+
+def test_split_points_are_sorted_quantiles(events):
+    points = events.split_points('n', 4, sample_size=200)
+    assert points == [25, 50, 75]
+    assert events.split_points('n', 1) == []
+    assert events.split_points('n', 4, filter={'kind': 'x'}) == []
+
+
+def test_partition_conditions_cover_every_document_once(events):
+    conds = events.partition_conditions('n', 4, filter={'kind': 'a'})
+    assert len(conds) == 4
+    ids = [a['_id'] for c in conds for a in events.collection.find(c)]
+    assert len(ids) == len(set(ids)) == events.collection.count_documents({'kind': 'a'})
+    conds = events.partition_conditions('n', 4)
+    assert sum([events.collection.count_documents(c) for c in conds]) == 102
+
+
+def test_parallel_scan_merges_partitions_with_reducer(events):
+    count = lambda store, cond: store.collection.count_documents(cond)
+    assert events.parallel_scan(count, lambda a, b: a + b, key='n', partitions=4, workers=2) == 102
+    rs = events.parallel_scan(count, key='n', partitions=4, workers=2)
+    assert len(rs) == 4 and sum(rs) == 102
+    rs = events.parallel_aggregate([{'$group': {'_id': '$kind', 'c': {'$sum': 1}}}], key='n', partitions=4, workers=2)
+    totals = {}
+    for a in rs:
+        totals[a['_id']] = totals.get(a['_id'], 0) + a['c']
+    assert totals == {'a': 51, 'b': 50, None: 1}
+
+
+def test_parallel_scan_processes_rebuild_store_on_same_database(events, monkeypatch):
+    import concurrent.futures
+    # mongomock data does not cross processes; run the spec path on threads
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+    dbs = lambda store, cond: (store.db.name, store.server, type(store))
+    rs = events.parallel_scan(dbs, key='n', partitions=2, workers=2, processes=True)
+    assert set(rs) == {('analytics', events.server, Events)}
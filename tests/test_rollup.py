@@ -0,0 +1,58 @@
+import datetime
+
+from xyz_util.mongoutils import Store, Rollup, ROLLUP_META, date_format
+
+DAY = date_format('created')
+
+
+def daily(**kwargs):
+    return Rollup('orders', 'orders_daily', {'day': DAY, 'shop': '$shop'},
+                  {'count': {'$sum': 1}, 'amount': {'$sum': '$amount'}}, **kwargs)
+
+
+class Orders(Store):
+    name = 'orders'
+    rollups = [daily()]
+
+
+def test_covers_dimensions_measures_and_filters():
+    r = daily(filter={'status': 'paid'})
+    assert r.covers(DAY, {'count': {'$sum': 1}}, {'status': 'paid'})
+    assert r.covers(['shop'], ['amount'], {'status': 'paid', 'shop': 'a'})
+    assert r.covers('shop', {'count': {'$sum': 1}, 'amount': {'$sum': '$amount'}}, {'status': 'paid'})
+    # the rollup only holds paid orders
+    assert not r.covers('shop', {'count': {'$sum': 1}}, {})
+    assert not r.covers('shop', {'count': {'$sum': 1}}, {'status': 'new'})
+    # not a dimension, a different measure, or a filter on something that is not a dimension
+    assert not r.covers('city', {'count': {'$sum': 1}}, {'status': 'paid'})
+    assert not r.covers('shop', {'amount': {'$max': '$amount'}}, {'status': 'paid'})
+    assert not r.covers('shop', {'count': {'$sum': 1}}, {'status': 'paid', 'amount': {'$gt': 5}})
+    assert not r.covers('shop', {'count': {'$sum': 1}}, {'status': 'paid', '$or': [{'shop': 'a'}]})
+
+
+def test_group_by_reads_rollup_with_id_dimensions(mongo):
+    Store(name='orders_daily').collection.insert_many([
+        {'_id': {'day': '2024-01-01', 'shop': 'a'}, 'count': 2, 'amount': 30},
+        {'_id': {'day': '2024-01-01', 'shop': 'b'}, 'count': 1, 'amount': 5},
+        {'_id': {'day': '2024-01-02', 'shop': 'a'}, 'count': 4, 'amount': 12},
+    ])
+    s = Orders()
+    assert s.count_by(DAY) == {'2024-01-01': 3, '2024-01-02': 4}
+    assert s.count_by('shop', filter={'shop': 'a'}) == {'a': 6}
+    rs = sorted(s.group_by(['shop'], ['amount']), key=lambda a: a['_id']['shop'])
+    assert [(a['_id'], a['amount']) for a in rs] == [({'shop': 'a'}, 42), ({'shop': 'b'}, 5)]
+    # uncovered queries still run on the source collection
+    s.collection.insert_one({'shop': 'a', 'city': 'gz', 'amount': 1, 'created': datetime.datetime(2024, 1, 1)})
+    assert s.count_by('city') == {'gz': 1}
+
+
+def test_concurrent_refresh_does_not_merge_the_same_window(mongo):
+    Store(name='orders').collection.insert_one({'shop': 'a', 'amount': 1, 'created': datetime.datetime(2024, 1, 1)})
+    r, other = daily(), daily()
+    assert other.acquire() is not None
+    # the lease is held, so this returns before running the $merge pipeline
+    assert r.refresh() is None
+    other.release(watermark=5)
+    assert r.acquire()['watermark'] == 5
+    assert other.acquire() is None
+    assert Store(name=ROLLUP_META).collection.count_documents({}) == 1
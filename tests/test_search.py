@@ -0,0 +1,57 @@
+import pytest
+
+from xyz_util.mongoutils import Store, SEARCH_TOKENS_FIELD
+
+
+class Articles(Store):
+    name = 'articles'
+    search_fields = ['title', 'body']
+    ordering = ('id',)
+
+
+@pytest.fixture
+def articles(mongo):
+    s = Articles()
+    s.create_search_index('ngram')
+    return s
+
+
+def found(s, q):
+    return [a['id'] for a in s.find({'search': q})]
+
+
+def test_get_or_create_paths_index_tokens(articles):
+    articles.get_or_create({'id': 1}, {'title': 'hello', 'body': 'world'})
+    articles.get_or_create({'id': 2}, {'title': 'partial'})
+    articles.get_or_create_many([{'id': 3}, {'id': 4}], defaults=lambda c: {'title': 'many%d' % c['id']})
+    assert found(articles, 'world') == [1]
+    assert found(articles, 'partial') == [2]
+    assert found(articles, 'many4') == [4]
+
+
+def test_batch_upsert_refreshes_partial_updates(articles):
+    articles.batch_upsert([{'id': 1, 'title': 'old', 'body': 'text'}, {'id': 2, 'title': 'other', 'body': 'x'}])
+    articles.batch_upsert([{'id': 1, 'title': 'new'}], chunk=1)
+    assert found(articles, 'new') == [1]
+    assert found(articles, 'old') == []
+    assert found(articles, 'text') == [1]
+
+
+def test_viewset_create_indexes_tokens(articles):
+    from tests.test_views import call
+    from xyz_util.mongoutils import MongoViewSet
+
+    class ArticleViewSet(MongoViewSet):
+        store_class = Articles
+
+    r = call('post', {'id': 5, 'title': 'created'}, action='create', view_class=ArticleViewSet)
+    assert r.status_code == 200
+    assert articles.collection.find_one({'id': 5})[SEARCH_TOKENS_FIELD] == ['created']
+
+
+def test_update_refreshes_documents_that_no_longer_match(articles):
+    articles.batch_upsert([{'id': 1, 'title': 'old', 'body': 'text'}, {'id': 2, 'title': 'old', 'body': 'more'}])
+    articles.update({'title': 'old'}, {'title': 'newword'})
+    assert found(articles, 'newword') == [1, 2]
+    assert found(articles, 'old') == []
+    assert found(articles, 'more') == [2]
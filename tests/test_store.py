@@ -0,0 +1,205 @@
+import pytest
+
+from xyz_util.mongoutils import Store, MIGRATION_META
+
+
+class Users(Store):
+    name = 'users'
+
+
+def test_batch_update_resumes_and_picks_up_new_documents(mongo):
+    s = Users()
+    s.collection.insert_many([{'id': i, 'age': str(i)} for i in range(5)])
+    r = s.batch_update({'$set': {'seen': 1}}, batch_size=2, checkpoint='mark_seen')
+    assert r['done'] and r['batches'] == 3 and r['modified'] == 5
+    s.collection.insert_one({'id': 5, 'age': '5'})
+    r = s.batch_update({'$set': {'seen': 1}}, batch_size=2, checkpoint='mark_seen')
+    assert r['done'] and r['modified'] == 6
+    assert s.collection.count_documents({'seen': 1}) == 6
+
+
+def test_change_field_type_rerun_with_other_filter_and_new_documents(mongo):
+    s = Users()
+    s.collection.insert_many([{'id': i, 'kind': i % 2, 'age': str(i)} for i in range(6)])
+    s.change_field_type({'age': 'toInt'}, filter={'kind': 0}, batch_size=2)
+    assert s.collection.count_documents({'age': {'$type': 'int'}}) == 3
+    s.change_field_type({'age': 'toInt'}, filter={'kind': 1}, batch_size=2)
+    assert s.collection.count_documents({'age': {'$type': 'int'}}) == 6
+    s.collection.insert_one({'id': 6, 'kind': 0, 'age': '6'})
+    s.change_field_type({'age': 'toInt'}, filter={'kind': 0}, batch_size=2)
+    assert s.collection.find_one({'id': 6})['age'] == 6
+    assert Store(name=MIGRATION_META).collection.count_documents({}) == 2
+
+
+def wait_for(check, timeout=2):
+    import time
+    end = time.time() + timeout
+    while time.time() < end:
+        if check():
+            return True
+        time.sleep(0.01)
+    return check()
+
+
+def test_write_buffer_keeps_interval_flushing_after_with_block(mongo):
+    from xyz_util.mongoutils import WriteBuffer
+
+    buffer = WriteBuffer(interval=0.05)
+    s = Users()
+    s.write_buffer = buffer
+    with buffer:
+        s.inc({'id': 1}, {'views': 1})
+    assert s.collection.find_one({'id': 1})['views'] == 1
+    s.inc({'id': 1}, {'views': 2})
+    assert wait_for(lambda: s.collection.find_one({'id': 1})['views'] == 3)
+    buffer.close()
+    s.inc({'id': 1}, {'views': 1})
+    assert wait_for(lambda: s.collection.find_one({'id': 1})['views'] == 4)
+    buffer.close()
+
+
+def test_write_buffer_burst_uses_one_flusher_thread(mongo, monkeypatch):
+    import threading
+    from xyz_util.mongoutils import WriteBuffer
+
+    started = []
+    start = threading.Thread.start
+    monkeypatch.setattr(threading.Thread, 'start', lambda self: started.append(self) or start(self))
+    buffer = WriteBuffer(max_size=2, interval=10)
+    s = Users()
+    s.write_buffer = buffer
+    for i in range(200):
+        s.inc({'id': i}, {'views': 1})
+    assert len(started) == 1
+    assert wait_for(lambda: s.collection.count_documents({}) == 200)
+    buffer.close()
+
+
+def test_write_buffer_requeues_failed_writes(mongo, monkeypatch):
+    import mongomock
+    from pymongo.errors import AutoReconnect
+    from xyz_util.mongoutils import WriteBuffer
+
+    calls = []
+    bulk_write = mongomock.collection.Collection.bulk_write
+
+    def flaky(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise AutoReconnect('down')
+        return bulk_write(self, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', flaky)
+    buffer = WriteBuffer(interval=0)
+    s = Users()
+    s.write_buffer = buffer
+    s.inc({'id': 1}, {'views': 2})
+    s.add_to_set({'id': 1}, {'tags': 'a'})
+    buffer.flush()
+    assert s.collection.find_one({'id': 1}) is None
+    s.inc({'id': 1}, {'views': 1})
+    buffer.flush()
+    d = s.collection.find_one({'id': 1})
+    assert d['views'] == 3 and d['tags'] == ['a']
+    assert buffer.metrics['requeued'] == 1
+
+
+def test_instrument_records_sum_and_abandoned_cursors(mongo, monkeypatch):
+    import gc
+    from xyz_util.mongoutils import QueryInstrument
+
+    instrument = QueryInstrument()
+    monkeypatch.setattr(Users, 'instrument', instrument)
+    s = Users()
+    s.collection.insert_many([{'id': i, 'age': i} for i in range(5)])
+    assert s.sum('age') == 10
+    rs = s.find()
+    next(rs)
+    del rs
+    gc.collect()
+    counters = instrument.sink.counters
+    assert counters[('users', 'sum')]['calls'] == 1
+    assert counters[('users', 'find')] == dict(calls=1, ms=counters[('users', 'find')]['ms'], docs=1)
+
+
+def test_get_or_create_many_rereads_only_on_duplicate_keys(mongo, monkeypatch):
+    import pytest
+    from pymongo.errors import BulkWriteError
+
+    s = Users()
+    s.collection.create_index('id', unique=True)
+    insert_many = type(s.collection).insert_many
+
+    def racing(self, docs, *args, **kwargs):
+        self.insert_one({'id': 2, 'name': 'winner'})
+        return insert_many(self, docs, *args, **kwargs)
+
+    monkeypatch.setattr(type(s.collection), 'insert_many', racing)
+    rs = s.get_or_create_many([{'id': 1}, {'id': 2}], {'name': 'new'})
+    assert [a['name'] for a in rs] == ['new', 'winner']
+
+    def failing(self, docs, *args, **kwargs):
+        raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'validation failed'}]})
+
+    monkeypatch.setattr(type(s.collection), 'insert_many', failing)
+    with pytest.raises(BulkWriteError):
+        s.get_or_create_many([{'id': 3}])
+
+
+@pytest.mark.parametrize('direction', [1, -1])
+def test_keyset_find_pages_through_null_sort_values(mongo, direction):
+    s = Users()
+    s.collection.insert_many([{'id': i, 'name': 'n%02d' % i} if i % 3 else
+                              ({'id': i, 'name': None} if i % 2 else {'id': i}) for i in range(12)])
+    seen, after = [], None
+    while True:
+        rs, after = s.keyset_find(sort=[('name', direction)], after=after, limit=3)
+        seen += [a['id'] for a in rs]
+        if not after:
+            break
+    expected = [a['id'] for a in s.collection.find({}, sort=[('name', direction), ('_id', direction)])]
+    assert seen == expected and len(seen) == 12
+
+
+class Sampled(Store):
+    name = 'sampled'
+    random_field = 'rand'
+
+
+def test_random_key_find_tops_up_overlapping_probes(mongo, monkeypatch):
+    import random
+    s = Sampled()
+    s.collection.insert_many([{'id': i, 'rand': random.random()} for i in range(200)])
+    monkeypatch.setattr('xyz_util.mongoutils.random.random', lambda: 0.5)
+    rs = s.random_key_find(count=10, fields=['id'])
+    assert len(rs) == 10 and len(set([a['id'] for a in rs])) == 10
+    assert all(['_id' not in a for a in rs])
+    assert len(s.random_key_find({'id': {'$lt': 4}}, count=10)) == 4
+
+
+def test_upsert_paths_set_random_field(mongo):
+    from xyz_util.mongoutils import WriteBuffer
+    s = Sampled()
+    s.inc({'id': 1}, {'views': 1})
+    s.add_to_set({'id': 2}, {'tags': 'a'})
+    s.write_buffer = WriteBuffer(interval=0)
+    s.inc({'id': 3}, {'views': 1})
+    s.add_to_set({'id': 4}, {'tags': 'a'})
+    s.write_buffer.flush()
+    s.inc({'id': 1}, {'views': 1})
+    s.write_buffer.flush()
+    ds = list(s.collection.find({}, sort=[('id', 1)]))
+    assert [a['id'] for a in ds] == [1, 2, 3, 4]
+    assert all([isinstance(a['rand'], float) for a in ds])
+    assert ds[0]['views'] == 2
+
+
+def test_save_distinct_sketch_keys_on_precision(mongo, monkeypatch):
+    from xyz_util.datautils import HyperLogLog
+    calls = []
+    # mongomock cannot run the $range/$map pipeline update
+    monkeypatch.setattr(type(Users().collection), 'update_one', lambda self, *args, **kwargs: calls.append(args))
+    Users().save_distinct_sketch('age', '2024-01-01', HyperLogLog(10))
+    Users().save_distinct_sketch('age', '2024-01-01', HyperLogLog(12))
+    assert [a[0]['precision'] for a in calls] == [10, 12]
+    assert 'precision' not in calls[0][1][0]['$set']
@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+
+from xyz_util.mongoutils import get_tzinfo, time_step, parse_time_bucket, densify_time_buckets, time_bucket_overlaps
+
+dt = datetime.datetime
+UTC = datetime.timezone.utc
+
+
+def test_get_tzinfo_offsets_and_names():
+    assert get_tzinfo(None) is UTC
+    assert get_tzinfo('+08:00').utcoffset(None) == datetime.timedelta(hours=8)
+    assert get_tzinfo('-0530').utcoffset(None) == -datetime.timedelta(hours=5, minutes=30)
+    assert get_tzinfo('Asia/Shanghai').utcoffset(dt(2024, 1, 1)) == datetime.timedelta(hours=8)
+
+
+@pytest.mark.parametrize('start, unit, n, tz, expected', [
+    (dt(2024, 1, 1, 23, 59), 'minute', 2, None, dt(2024, 1, 2, 0, 1)),
+    (dt(2024, 1, 1), 'hour', -1, '+08:00', dt(2023, 12, 31, 23)),
+    (dt(2024, 1, 1), 'week', 1, None, dt(2024, 1, 8)),
+    (dt(2024, 1, 1), 'month', 1, None, dt(2024, 2, 1)),
+    (dt(2024, 1, 1), 'quarter', -1, None, dt(2023, 10, 1)),
+    (dt(2023, 11, 1), 'quarter', 1, None, dt(2024, 2, 1)),
+    # local midnight in +08:00 is 16:00 UTC the day before
+    (dt(2023, 12, 31, 16), 'year', 1, '+08:00', dt(2024, 12, 31, 16)),
+    (dt(2024, 2, 29, 16), 'day', 1, 'Asia/Shanghai', dt(2024, 3, 1, 16)),
+])
+def test_time_step(start, unit, n, tz, expected):
+    assert time_step(start, unit, n, get_tzinfo(tz) if tz else None) == expected
+
+
+def test_time_step_days_follow_local_midnight_across_dst():
+    ny = get_tzinfo('America/New_York')
+    # 2024-03-10 the clocks spring forward: local midnight moves from 05:00 to 04:00 UTC
+    assert time_step(dt(2024, 3, 10, 5), 'day', 1, ny) == dt(2024, 3, 11, 4)
+    assert time_step(dt(2024, 3, 11, 4), 'day', -1, ny) == dt(2024, 3, 10, 5)
+    assert time_step(dt(2024, 3, 4, 5), 'week', 1, ny) == dt(2024, 3, 11, 4)
+    assert time_step(dt(2024, 10, 1, 4), 'month', 1, ny) == dt(2024, 11, 1, 4)
+    assert time_step(dt(2024, 11, 1, 4), 'month', 1, ny) == dt(2024, 12, 1, 5)
+
+
+@pytest.mark.parametrize('key, unit, tz, expected', [
+    ('2024-03-01T10:05', 'minute', None, dt(2024, 3, 1, 10, 5)),
+    ('2024-03-01T10', 'hour', '+08:00', dt(2024, 3, 1, 2)),
+    ('2024-03-01', 'day', 'Asia/Shanghai', dt(2024, 2, 29, 16)),
+    ('2024-03', 'month', None, dt(2024, 3, 1)),
+    ('2024', 'year', '-05:00', dt(2024, 1, 1, 5)),
+    # ISO weeks start on Monday; week 1 of 2021 begins on 2021-01-04
+    ('2021-01', 'week', None, dt(2021, 1, 4)),
+    ('2020-53', 'week', None, dt(2020, 12, 28)),
+    ('2024-01', 'week', '+08:00', dt(2023, 12, 31, 16)),
+])
+def test_parse_time_bucket(key, unit, tz, expected):
+    assert parse_time_bucket(key, unit, get_tzinfo(tz)) == expected
+
+
+def test_densify_time_buckets_fills_gaps_and_bounds():
+    assert densify_time_buckets([], 'day', start=dt(2024, 1, 1), end=dt(2024, 1, 5)) == []
+    days = lambda *ds: [dt(2024, 1, d) for d in ds]
+    assert densify_time_buckets(days(2, 5), 'day') == days(2, 3, 4, 5)
+    assert densify_time_buckets(days(2, 5), 'day', gaps=False) == days(2, 5)
+    assert densify_time_buckets(days(3), 'day', start=dt(2024, 1, 1, 12), end=dt(2024, 1, 5)) == days(1, 2, 3, 4, 5)
+    assert densify_time_buckets(days(1, 7), 'day', n=3) == days(1, 4, 7)
+    months = densify_time_buckets([dt(2024, 1, 1)], 'month', end=dt(2024, 3, 15))
+    assert months == [dt(2024, 1, 1), dt(2024, 2, 1), dt(2024, 3, 1)]
+
+
+def test_densify_time_buckets_with_timezone():
+    ny = get_tzinfo('America/New_York')
+    r = densify_time_buckets([dt(2024, 3, 9, 5), dt(2024, 3, 12, 4)], 'day', tzinfo=ny)
+    assert r == [dt(2024, 3, 9, 5), dt(2024, 3, 10, 5), dt(2024, 3, 11, 4), dt(2024, 3, 12, 4)]
+    aware = datetime.datetime(2024, 3, 13, tzinfo=ny)
+    assert densify_time_buckets(r[-1:], 'day', tzinfo=ny, end=aware) == [dt(2024, 3, 12, 4), dt(2024, 3, 13, 4)]
+
+
+def test_time_bucket_overlaps():
+    assert time_bucket_overlaps(dt(2024, 1, 1), 'day', 1, UTC, start=dt(2024, 1, 1, 12))
+    assert not time_bucket_overlaps(dt(2024, 1, 1), 'day', 1, UTC, start=dt(2024, 1, 2))
+    assert not time_bucket_overlaps(dt(2024, 1, 3), 'day', 1, UTC, end=dt(2024, 1, 2, 23))
+    assert time_bucket_overlaps(dt(2024, 1, 3), 'week', 1, UTC)
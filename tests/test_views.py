@@ -0,0 +1,168 @@
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+from django.contrib.auth.models import User
+
+from xyz_util.mongoutils import Store, MongoViewSet
+
+
+class Items(Store):
+    name = 'items'
+    ordering = ('id',)
+
+
+class ItemViewSet(MongoViewSet):
+    store_class = Items
+
+
+def call(method, params=None, action='list', view_class=ItemViewSet, **kwargs):
+    factory = APIRequestFactory()
+    if method == 'get':
+        request = factory.get('/items/', params)
+    else:
+        request = getattr(factory, method)('/items/', params, format='json')
+    force_authenticate(request, User(username='admin', is_staff=True, is_superuser=True))
+    return view_class.as_view({method: action})(request, **kwargs)
+
+
+def test_control_params_are_not_filters(mongo):
+    Items().collection.insert_many([{'id': i} for i in range(30)])
+    r = call('get', {'cursor': '', 'page_size': 10, 'ordering': '-id'})
+    assert [a['id'] for a in r.data['results']] == list(range(29, 19, -1))
+    r = call('get', {'page': 2, 'page_size': 10})
+    assert r.data['count'] == 30
+    assert [a['id'] for a in r.data['results']] == list(range(10, 20))
+    r = call('get', {'_random': 3})
+    assert len(r.data['results']) == 3
+
+
+class CappedItems(Items):
+    count_limit = 150
+
+
+class CappedItemViewSet(MongoViewSet):
+    store_class = CappedItems
+
+
+def test_capped_count_pages_stay_reachable(mongo):
+    Items().collection.insert_many([{'id': i, 'kind': 'a'} for i in range(400)])
+    get = lambda page: call('get', {'page': page, 'kind': 'a'}, view_class=CappedItemViewSet)
+    r = get(2)
+    assert r.status_code == 200
+    assert r.data['count'] == '150+'
+    assert [a['id'] for a in r.data['results']] == list(range(100, 200))
+    assert r.data['next']
+    r = get(4)
+    assert len(r.data['results']) == 100
+    assert r.data['next'] is None
+    assert get(5).status_code == 404
+
+
+def test_count_below_cap_is_exact(mongo):
+    Items().collection.insert_many([{'id': i, 'kind': 'a'} for i in range(120)])
+    get = lambda page: call('get', {'page': page, 'kind': 'a'}, view_class=CappedItemViewSet)
+    r = get(2)
+    assert r.data['count'] == 120
+    assert len(r.data['results']) == 20
+    assert get(3).status_code == 404
+
+
+class Posts(Store):
+    name = 'posts'
+    ordering = ('id',)
+    # mongomock cannot run the $reduce schema profile
+    _fields = {'id': 'integer', 'title': 'string', 'meta': 'object', 'meta.lang': 'string', 'user': 'oid'}
+
+
+class PostViewSet(MongoViewSet):
+    store_class = Posts
+    foreign_keys = {'user': 'people'}
+
+
+def post_results(params):
+    r = call('get', params, view_class=PostViewSet)
+    assert r.status_code == 200, r.data
+    return r.data['results']
+
+
+@pytest.fixture
+def posts(mongo):
+    uid = Store(name='people').collection.insert_one({'name': 'ann', 'age': 30}).inserted_id
+    Posts().collection.insert_one({'id': 1, 'title': 't', 'meta': {'lang': 'en', 'words': 3}, 'user': uid})
+
+
+def test_fields_and_exclude_params(posts):
+    d = post_results({'fields': 'id,meta.lang'})[0]
+    assert d == {'_id': d['_id'], 'id': 1, 'meta': {'lang': 'en'}}
+    d = post_results({'exclude': 'title,meta.words'})[0]
+    assert 'title' not in d and d['meta'] == {'lang': 'en'} and d['user']['name'] == 'ann'
+    r = call('get', {'fields': 'id,nope'}, view_class=PostViewSet)
+    assert r.status_code == 400
+
+
+def test_foreign_key_sub_paths_in_fields_and_exclude(posts):
+    d = post_results({'fields': 'id,user.name'})[0]
+    assert set(d['user']) == {'_id', 'name'}
+    d = post_results({'exclude': 'user.age'})[0]
+    assert set(d['user']) == {'_id', 'name'} and d['title'] == 't'
+    d = post_results({'fields': 'id,user.name', 'exclude': 'user.age'})[0]
+    assert set(d['user']) == {'_id', 'name'}
+
+
+class SampledItems(Items):
+    random_field = 'rand'
+
+
+class SampledItemViewSet(MongoViewSet):
+    store_class = SampledItems
+
+
+def test_create_and_batch_upsert_set_random_field(mongo):
+    from bson import ObjectId
+    r = call('post', {'id': 1}, action='create', view_class=SampledItemViewSet)
+    assert r.status_code == 200, r.data
+    id = str(ObjectId())
+    r = call('post', [{'_id': id, 'changes': {'id': 2}, 'upsert': True}], action='batch', view_class=SampledItemViewSet)
+    assert r.status_code == 200, r.data
+    assert all([isinstance(a.get('rand'), float) for a in SampledItems().collection.find()])
+
+
+def test_batch_reports_errors_and_signals_only_written_items(mongo, monkeypatch):
+    from bson import ObjectId
+    from pymongo.errors import BulkWriteError
+    from xyz_util.mongoutils import mongo_batch_posted, mongo_posted
+    s = Items()
+    bulk_write = type(s.collection).bulk_write
+
+    def with_ops(self, ops, **kwargs):
+        # the server echoes the failed op, whose ObjectIds are not JSON serializable; mongomock leaves it out
+        try:
+            return bulk_write(self, ops, **kwargs)
+        except BulkWriteError as e:
+            for w in e.details['writeErrors']:
+                w.setdefault('op', ops[w['index']]._filter)
+            raise
+
+    monkeypatch.setattr(type(s.collection), 'bulk_write', with_ops)
+    s.collection.create_index('id', unique=True)
+    a, b = s.collection.insert_many([{'id': 1}, {'id': 2}]).inserted_ids
+    new, missing = ObjectId(), ObjectId()
+    batches, posts = [], []
+    on_batch = lambda sender, **kwargs: batches.append(kwargs)
+    on_post = lambda sender, **kwargs: posts.append(kwargs)
+    mongo_batch_posted.connect(on_batch, sender=ItemViewSet)
+    mongo_posted.connect(on_post, sender=ItemViewSet)
+    try:
+        r = call('post', [{'_id': str(a), 'changes': {'name': 'x'}},
+                          {'_id': str(b), 'changes': {'id': 1}},
+                          {'_id': str(new), 'changes': {'id': 3}, 'upsert': True},
+                          {'_id': str(missing), 'changes': {'name': 'y'}}], action='batch')
+    finally:
+        mongo_batch_posted.disconnect(on_batch, sender=ItemViewSet)
+        mongo_posted.disconnect(on_post, sender=ItemViewSet)
+    assert r.status_code == 200, r.data
+    r.render()
+    assert [set(e) for e in r.data['errors']] == [{'index', 'code', 'errmsg'}]
+    assert r.data['errors'][0]['index'] == 1 and r.data['upserted'] == 1
+    assert [d['id'] for d in batches[0]['instances']] == [1, 3]
+    assert batches[0]['created'] == [False, True]
+    assert [(d['instance']['id'], d['created']) for d in posts] == [(1, False), (3, True)]
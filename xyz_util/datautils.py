@@ -1,9 +1,12 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
-import re
+import re, math
+from hashlib import blake2b
 from six import text_type
 from datetime import date, datetime
 from collections import OrderedDict
+from decimal import Decimal
+from functools import cached_property, lru_cache
 
 
 def node2dict(node):
@@ -381,8 +384,14 @@ class Accessor(str):
     accesses. For convenience, the class has an alias `.A` to allow for more concise code.
 
     Relations are separated by a ``.`` character.
+
+    The path is split once, and for every step the lookup kind that worked is
+    remembered per container type, so repeated resolves over similar records
+    go straight to the right lookup. Use `compile_accessor` to share one
+    instance (and its cache) between calls.
     '''
     SEPARATOR = '.'
+    INDEX_TYPES = (list, tuple)
 
     def resolve(self, context, safe=True, quiet=False):
         '''
@@ -421,23 +430,23 @@ class Accessor(str):
         '''
         try:
             current = context
-            for bit in self.bits:
-                try:  # dictionary lookup
-                    current = current[bit]
-                except (TypeError, AttributeError, KeyError):
-                    try:  # attribute lookup
+            lookups = self.lookups
+            for i, bit in enumerate(self.bits):
+                key = (i, type(current))
+                kind = lookups.get(key)
+                try:
+                    if kind == 'item':
+                        current = current[bit]
+                    elif kind == 'attr':
                         current = getattr(current, bit)
-                    except (TypeError, AttributeError):
-                        try:  # list-index lookup
-                            current = current[int(bit)]
-                        except (IndexError,  # list index out of range
-                                ValueError,  # invalid literal for int()
-                                KeyError,  # dict without `int(bit)` key
-                                TypeError,  # unsubscriptable object
-                                ):
-                            raise ValueError('Failed lookup for key [%s] in %r'
-                                             ', when resolving the accessor %s' % (bit, current, self)
-                                             )
+                    elif kind == 'index':
+                        current = current[int(bit)]
+                    else:
+                        raise LookupError
+                except (TypeError, AttributeError, LookupError, ValueError):
+                    current, kind = self.lookup(current, bit)
+                    if kind:
+                        lookups[key] = kind
                 if callable(current):
                     if safe and getattr(current, 'alters_data', False):
                         raise ValueError('refusing to call %s() because `.alters_data = True`'
@@ -454,11 +463,48 @@ class Accessor(str):
             if not quiet:
                 raise
 
-    @property
+    def lookup(self, current, bit):
+        '''
+        Full dictionary -> attribute -> list-index lookup of one step.
+
+        Returns the value and the lookup kind if it is safe to reuse for every
+        object of the same type, else None (e.g. an attribute found after a
+        `KeyError` on a mapping, which may hold the key on the next record).
+        '''
+        try:  # dictionary lookup
+            return current[bit], 'item'
+        except (TypeError, AttributeError, KeyError) as e:
+            by_type = not isinstance(e, KeyError)
+        try:  # attribute lookup
+            return getattr(current, bit), 'attr' if by_type else None
+        except (TypeError, AttributeError):
+            pass
+        try:  # list-index lookup
+            return current[int(bit)], 'index' if type(current) in self.INDEX_TYPES else None
+        except (IndexError,  # list index out of range
+                ValueError,  # invalid literal for int()
+                KeyError,  # dict without `int(bit)` key
+                TypeError,  # unsubscriptable object
+                ):
+            raise ValueError('Failed lookup for key [%s] in %r'
+                             ', when resolving the accessor %s' % (bit, current, self)
+                             )
+
+    def resolve_many(self, records, safe=True, quiet=False):
+        '''
+        Resolve the accessor against every object in *records*, returning a list.
+        '''
+        return [self.resolve(r, safe=safe, quiet=quiet) for r in records]
+
+    @cached_property
+    def lookups(self):
+        return {}
+
+    @cached_property
     def bits(self):
         if self == '':
             return ()
-        return self.split(self.SEPARATOR)
+        return tuple(self.split(self.SEPARATOR))
 
     def get_field(self, model):
         '''Return the django model field for model in context, following relations'''
@@ -491,14 +537,19 @@ class Accessor(str):
 
         '''
         path, _, remainder = self.rpartition('.')
-        return A(path).resolve(context, quiet=quiet), remainder
+        return compile_accessor(path).resolve(context, quiet=quiet), remainder
 
 
 A = Accessor  # alias
 
 
+@lru_cache(maxsize=1024)
+def compile_accessor(path):
+    return Accessor(path)
+
+
 def access(obj, path, quiet=True):
-    return Accessor(path).resolve(obj, quiet=quiet)
+    return compile_accessor(path).resolve(obj, quiet=quiet)
 
 def access_list(obj, path):
     ps = path.split('.*.')
@@ -512,6 +563,72 @@ def access_list(obj, path):
 
 
 
+def normalize_number(v):
+    """
+    把数值统一成int或float, 使5、Int64(5)、5.0、Decimal128('5')得到同一个值(与mongo $group的比较一致), bool不变
+    """
+    if hasattr(v, 'to_decimal'):
+        v = v.to_decimal()
+    if isinstance(v, bool) or not isinstance(v, (int, float, Decimal)):
+        return v
+    if isinstance(v, Decimal):
+        return int(v) if v.is_finite() and v == v.to_integral_value() else float(v)
+    return int(v) if isinstance(v, int) or v.is_integer() else v
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog基数估计, precision(4~16)越大越准, 标准误差约1.04/sqrt(2**precision).
+    registers可序列化保存, 同precision的sketch可以merge.
+
+        >>> h = HyperLogLog(precision=12)
+        >>> h.update(range(1000))
+        >>> abs(h.count() - 1000) < 50
+        True
+    """
+
+    def __init__(self, precision=14, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError('expected %d registers, got %d' % (self.m, len(self.registers)))
+
+    def add(self, value):
+        if not isinstance(value, bytes):
+            value = repr(normalize_number(value)).encode('utf8')
+        h = int.from_bytes(blake2b(value, digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('can not merge sketches with different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.m
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m) or 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        if e <= 2.5 * m:
+            zeros = self.registers.count(0)
+            if zeros:
+                e = m * math.log(m / zeros)
+        return int(round(e))
+
+    __len__ = count
+
+
 def import_function(s):
     import importlib
     ps = s.split(':')
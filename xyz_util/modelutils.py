@@ -309,8 +309,8 @@ def get_object_accessor_value(record, accessor):
                 return display_fn()
         except models.FieldDoesNotExist:
             pass
-    from .datautils import A
-    v = A(remainder).resolve(penultimate, quiet=True)
+    from .datautils import compile_accessor
+    v = compile_accessor(remainder).resolve(penultimate, quiet=True)
     if isinstance(v, Model):
         return text_type(v)
     elif hasattr(v, 'update_or_create'):  # a Model Manager ?
@@ -319,20 +319,20 @@ def get_object_accessor_value(record, accessor):
 
 
 def object2dict4display(obj, fields):
-    from .datautils import A
+    from .datautils import compile_accessor
     return OrderedDict(
         [(f, {
             "name": f,
             "verbose_name": get_related_field_verbose_name(obj, f),
-            "value": get_object_accessor_value(obj, A(f))
+            "value": get_object_accessor_value(obj, compile_accessor(f))
         }
           ) for f in fields]
     )
 
 
 def get_objects_accessor_data(accessors, content_type_id, object_ids):
-    from .datautils import Accessor
-    acs = [Accessor(a) for a in accessors]
+    from .datautils import compile_accessor
+    acs = [compile_accessor(a) for a in accessors]
     ct = ContentType.objects.get_for_id(content_type_id)
     for id in object_ids:
         obj = ct.get_object_for_this_type(id=id)
@@ -1,14 +1,19 @@
 # -*- coding:utf-8 -*- 
 # author = 'denishuang'
 from __future__ import unicode_literals
-from functools import cached_property
+from functools import cached_property, lru_cache
 import datetime, json
-import os, re
+import os, re, threading, time, random
+import logging, bisect, collections, weakref
 
-from .datautils import access, import_function
+from .datautils import access, import_function, HyperLogLog
 from six import text_type
 from bson import json_util, ObjectId
 from bson.objectid import ObjectId
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 SERVER = os.getenv('MONGO_SERVER', 'localhost:27017')
 if not SERVER.startswith('mongodb://'):
@@ -16,8 +21,14 @@ if not SERVER.startswith('mongodb://'):
 CONN = SERVER.replace('mongodb://', '')
 DB = os.getenv('MONGO_DB') or ('/' in CONN and CONN.split('/')[1]) or os.path.basename(os.getcwd())
 TIMEOUT = 3000
+POOL_OPTIONS = {}
+for k, o in [('MAX_POOL_SIZE', 'maxPoolSize'), ('MIN_POOL_SIZE', 'minPoolSize'), ('MAX_IDLE_TIME_MS', 'maxIdleTimeMS')]:
+    a = os.getenv(f'MONGO_{k}')
+    if a:
+        POOL_OPTIONS[o] = int(a)
 
 USING_DJANGO = os.getenv('DJANGO_SETTINGS_MODULE')
+log = logging.getLogger(__name__)
 
 
 if USING_DJANGO:
@@ -35,11 +46,83 @@ if USING_DJANGO:
     a = access(settings, 'MONGODB.TIMEOUT')
     if a:
         TIMEOUT = a
-
-def loadMongoDB(server=SERVER, db=DB, timeout=TIMEOUT):
-    import pymongo
-    client = pymongo.MongoClient(server, serverSelectionTimeoutMS=timeout)
-    return getattr(client, db)
+    for k, o in [('MAX_POOL_SIZE', 'maxPoolSize'), ('MIN_POOL_SIZE', 'minPoolSize'), ('MAX_IDLE_TIME_MS', 'maxIdleTimeMS')]:
+        a = access(settings, f'MONGODB.{k}')
+        if a is not None:
+            POOL_OPTIONS[o] = a
+
+CLIENTS = {}
+ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS_PID = None
+
+
+def get_mongo_client(server=SERVER, timeout=TIMEOUT, **options):
+    '''
+    进程内共享的MongoClient, 按(server, timeout, options)复用, fork后的子进程会重新创建
+    '''
+    global _CLIENTS_PID
+    key = (server, timeout, tuple(sorted(options.items())))
+    pid = os.getpid()
+    with _CLIENTS_LOCK:
+        if _CLIENTS_PID != pid:
+            # MongoClient is not fork-safe, drop clients inherited from the parent process
+            CLIENTS.clear()
+            _CLIENTS_PID = pid
+        client = CLIENTS.get(key)
+        if client is None:
+            import pymongo
+            ops = dict(POOL_OPTIONS)
+            ops.update(options)
+            client = CLIENTS[key] = pymongo.MongoClient(server, serverSelectionTimeoutMS=timeout, **ops)
+    return client
+
+
+def get_async_mongo_client(server=SERVER, timeout=TIMEOUT, **options):
+    """
+    异步驱动的MongoClient, 优先用pymongo自带的AsyncMongoClient, 否则用motor.
+    在事件循环里调用时按循环缓存(循环被回收后随之释放), 循环结束前应await close_async_mongo_clients();
+    在循环外调用时每次新建, 由调用方负责关闭
+    """
+    import asyncio
+    try:
+        from pymongo import AsyncMongoClient
+    except ImportError:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    ops = dict(POOL_OPTIONS)
+    ops.update(options)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return AsyncMongoClient(server, serverSelectionTimeoutMS=timeout, **ops)
+    key = (server, timeout, tuple(sorted(options.items())))
+    with _CLIENTS_LOCK:
+        clients = ASYNC_CLIENTS.get(loop)
+        if clients is None:
+            clients = ASYNC_CLIENTS[loop] = {}
+        client = clients.get(key)
+        if client is None:
+            client = clients[key] = AsyncMongoClient(server, serverSelectionTimeoutMS=timeout, **ops)
+    return client
+
+
+async def close_async_mongo_clients():
+    import asyncio
+    with _CLIENTS_LOCK:
+        clients = ASYNC_CLIENTS.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await maybe_await(client.close())
+
+
+def close_mongo_clients():
+    with _CLIENTS_LOCK:
+        for client in CLIENTS.values():
+            client.close()
+        CLIENTS.clear()
+
+
+def loadMongoDB(server=SERVER, db=DB, timeout=TIMEOUT, **options):
+    return getattr(get_mongo_client(server, timeout, **options), db)
 
 
 LOADER = loadMongoDB
@@ -66,6 +149,36 @@ def ordering_to_sort(s):
     return (s, d)
 
 
+def encode_cursor(values):
+    import base64
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(s):
+    import base64
+    return json_util.loads(base64.urlsafe_b64decode(s.encode('ascii')).decode('utf8'))
+
+
+def keyset_condition(sort, values):
+    """
+    排在values之后的文档的条件. null和缺失的字段升序时排在最前, 降序时排在最后,
+    而$gt/$lt不会匹配null, 所以跨过null边界时要单独加上{f: None}或{f: {'$ne': None}}
+    """
+    ors = []
+    for i, (f, d) in enumerate(sort):
+        eq = dict([(sort[j][0], values[j]) for j in range(i)])
+        v = values[i]
+        if v is None:
+            rs = [{'$ne': None}] if d > 0 else []
+        else:
+            rs = [{'$gt' if d > 0 else '$lt': v}] + ([None] if d < 0 else [])
+        for r in rs:
+            c = dict(eq)
+            c[f] = r
+            ors.append(c)
+    return ors[0] if len(ors) == 1 else {'$or': ors}
+
+
 def mongo_id_value(id):
     if isinstance(id, ObjectId):
         return text_type(id)
@@ -82,19 +195,45 @@ def str_left(date_field, left=10):
         '$substr': [f"${date_field}", 0, left]
     }
 
-class Store(object):
+def date_trunc(date_field, unit='day', tz=None, bin_size=1):
+    d = {'date': f"${date_field}", 'unit': unit}
+    if bin_size != 1:
+        d['binSize'] = bin_size
+    if tz:
+        d['timezone'] = tz
+    if unit == 'week':
+        d['startOfWeek'] = 'monday'
+    return {'$dateTrunc': d}
+
+
+COUNT_CACHE = {}
+COUNT_CACHE_SIZE = 10000
+SCHEMA_CACHE = {}
+SCHEMA_CACHE_SIZE = 1000
+SCHEMA_CACHE_TTL = int(os.getenv('MONGO_SCHEMA_CACHE_TTL', 300))
+
+RECORD_QUERIES = os.getenv('MONGO_RECORD_QUERIES') in ['1', 'true']
+QUERY_SHAPES = {}
+QUERY_SHAPES_SIZE = 1000
+
+
+class StoreBase(object):
+    """
+    Store和AsyncStore共用的配置和不做I/O的方法: 过滤条件规范化, 字段类型转换, 聚合管道和分词的构造.
+    子类提供db/collection, _fields和get_search_backend
+    """
     name = 'test_mongo_store'
     timeout = TIMEOUT
     field_types = {}
     fields = None
     search_fields = []
     ordering = ('-id',)
-
-    def __init__(self, server=SERVER, db=DB, name=None):
-        self.db = LOADER(server, db, self.timeout)
-        self.collection = getattr(self.db, name or self.name)
-        if name:
-            self.name = name
+    client_options = {}
+    schema_sample_size = 1000
+    schema_cache_ttl = SCHEMA_CACHE_TTL
+    record_queries = RECORD_QUERIES
+    random_field = None
+    search_backend = None
 
     @cached_property
     def _field_type_map(self):
@@ -108,15 +247,124 @@ class Store(object):
                 fts[fn] = ft
         return fts
 
+    def _random_find_pipeline(self, cond={}, count=10, fields=None):
+        cond = self.normalize_filter(cond)
+        fs = [{'$match': cond}, {'$sample': {'size': count}}]
+        if fields:
+            fs.append({'$project': fields})
+        return fs
+
+    def _group_by_pipeline(self, field, aggregate={'count': {'$sum': 1}}, filter=None, unwind=False, prepare=[]):
+        filter = self.normalize_filter(filter)
+        if not prepare:
+            self._record_query(filter)
+        ps = []+ prepare
+        if filter:
+            ps.append({'$match': filter})
+        if unwind:
+            ps.append({'$unwind': '$%s' % field})
+        d = {'_id': group_expression(field)}
+        d.update(group_aggregate(aggregate))
+        ps.append({'$group': d})
+        return ps
+
+    def clean_data(self, data):
+        d = {}
+        for a in data.keys():
+            if self._fields and a not in self._fields:
+                continue
+            d[a] = data[a]
+
+        for t, fs in self.field_types.items():
+            for f in fs:
+                if f in d:
+                    d[f] = t(d[f])
+        return d
+
+    def normalize_filter(self, data, cast=False):
+        if not data:
+            return data
+        fs = self._fields if cast else None
+        fm = self._field_type_map if cast else {}
+        # print(fm, fs)
+        backend = self.get_search_backend() if self.search_fields and data.get('search') else None
+        return normalize_filter_condition(data, fm , fs, self.search_fields, search_backend=backend) #
+
+    def add_search_tokens(self, value):
+        """
+        ngram模式下, value包含全部search_fields时直接算好分词, 返回 (value, 是否还需要refresh_search_tokens)
+        """
+        if not self.search_fields or self.get_search_backend() != 'ngram':
+            return value, False
+        if not any([f in value for f in self.search_fields]):
+            return value, False
+        if not all([f in value for f in self.search_fields]):
+            return value, True
+        value = dict(value)
+        value[SEARCH_TOKENS_FIELD] = search_tokens([value.get(f) for f in self.search_fields])
+        return value, False
+
+    def _search_token_preset(self, preset, key, refresh):
+        """
+        batch_upsert用: 在preset之后算好分词; 只含部分search_fields的行把key值记到refresh, 写完后再补分词
+        """
+        if not self.search_fields:
+            return preset
+        keys = key if isinstance(key, (list, tuple)) else [key]
+
+        def prepare(a, i):
+            a, rf = self.add_search_tokens(preset(a, i) or a)
+            if rf:
+                refresh.append(tuple([a[k] for k in keys]))
+            return a
+
+        return prepare
+
+    def _record_query(self, filter, sort=None):
+        if self.record_queries:
+            record_query_shape(self.db.name, self.name, filter, sort)
+
+
+class Store(StoreBase):
+    count_cache_ttl = 0
+    count_limit = None
+    write_buffer = None
+    rollups = []
+    random_sample_threshold = 10000
+    instrument = None
+
+    def __init__(self, server=SERVER, db=DB, name=None):
+        self.server = server
+        if self.client_options:
+            self.db = LOADER(server, db, self.timeout, **self.client_options)
+        else:
+            self.db = LOADER(server, db, self.timeout)
+        self.collection = getattr(self.db, name or self.name)
+        if name:
+            self.name = name
+
     @cached_property
     def _fields(self):
-        fs = {}
-        for d in self.random_find(count=10):
-            fs.update(json_schema(d))
+        fs = schema_from_profile(self.profile())
         if self.fields and isinstance(self.fields, dict):
             fs.update(self.fields)
         return fs
 
+    def profile(self, filter=None, size=None, depth=3, refresh=False):
+        """
+        服务端统计字段类型分布和空值率, 结果按(db, collection, filter, size, depth)进程内缓存schema_cache_ttl秒.
+        size默认取schema_sample_size, 为0时统计全表
+        """
+        filter = self.normalize_filter(filter)
+        size = self.schema_sample_size if size is None else size
+        key = ('profile', self.db.name, self.name, json_util.dumps(filter, sort_keys=True), size, depth)
+        r = None if refresh else cache_get(SCHEMA_CACHE, key)
+        if r is None:
+            r = profile_schema(self.collection, filter, size=size, depth=depth)
+            if self.schema_cache_ttl:
+                cache_set(SCHEMA_CACHE, key, r, self.schema_cache_ttl, SCHEMA_CACHE_SIZE)
+        return r
+
     def random_get(self, *args, **kwargs):
         rs = list(self.random_find(args[0], count=1, **kwargs))
         return rs[0] if rs else None
@@ -129,96 +377,545 @@ class Store(object):
         return self.collection.find_one(cond)
 
     def get_or_create(self, cond, defaults={}):
-        a = self.get(cond)
-        if not a:
-            d = {}
-            d.update(cond)
-            d.update(defaults)
-            rs = self.collection.insert_one(d)
-            a = self.get({'_id': rs.inserted_id})
-        return a
-
-    def random_find(self, cond={}, count=10, fields=None):
+        if isinstance(cond, text_type):
+            return self.get(cond)
+        from pymongo import ReturnDocument
+        d = plain_fields(cond)
+        d.update(defaults)
+        if self.random_field:
+            d.setdefault(self.random_field, random.random())
+        d, refresh = self.add_search_tokens(d)
+        r = self.collection.find_one_and_update(self.normalize_filter(cond), {'$setOnInsert': d}, upsert=True,
+                                                return_document=ReturnDocument.AFTER)
+        if refresh and SEARCH_TOKENS_FIELD not in r:
+            self.refresh_search_tokens({'_id': r['_id']})
+        return r
+
+    def get_many(self, values, key='_id'):
+        """
+        一次$in(组合条件用$or)查询批量取文档, 返回与values同序的列表, 找不到的位置为None.
+        values可以是key的值列表(key为_id时字符串会转ObjectId), 也可以是等值条件dict的列表
+        """
+        values = list(values)
+        if not values:
+            return []
+        if isinstance(values[0], dict):
+            keys = sorted(values[0].keys())
+            conds = [tuple([c.get(k) for k in keys]) for c in values]
+        else:
+            keys = [key]
+            conds = [(ObjectId(v) if key == '_id' and isinstance(v, text_type) else v,) for v in values]
+        us = list(set(conds))
+        if len(keys) == 1:
+            q = {keys[0]: {'$in': [c[0] for c in us]}}
+        else:
+            q = {'$or': [dict(zip(keys, c)) for c in us]}
+        m = {}
+        for d in self.collection.find(q):
+            m.setdefault(tuple([access(d, k) for k in keys]), d)
+        return [m.get(c) for c in conds]
+
+    def get_or_create_many(self, conds, defaults={}):
+        """
+        批量get_or_create: 一次查询已有文档, 缺的用一次insert_many插入, 按conds顺序返回.
+        defaults可以是dict, 或者接收cond返回dict的函数
+        """
+        from pymongo.errors import BulkWriteError
+        conds = list(conds)
+        rs = self.get_many(conds)
+        created = {}
+        refresh = []
+        for c, r in zip(conds, rs):
+            k = tuple(sorted(c.items()))
+            if r is None and k not in created:
+                d = dict(c)
+                d.update(defaults(c) if callable(defaults) else defaults)
+                if self.random_field:
+                    d.setdefault(self.random_field, random.random())
+                d, rf = self.add_search_tokens(d)
+                if rf:
+                    refresh.append(k)
+                created[k] = d
+        if created:
+            try:
+                self.collection.insert_many(list(created.values()), ordered=False)
+            except BulkWriteError as e:
+                # 并发插入触发唯一索引冲突时, 以库里已有的为准; 其它写入错误照常抛出
+                if any([w.get('code') != 11000 for w in e.details.get('writeErrors', [])]):
+                    raise
+                ks = list(created.keys())
+                for k, d in zip(ks, self.get_many([dict(k) for k in ks])):
+                    created[k] = d
+            ids = [created[k]['_id'] for k in refresh if created[k] and '_id' in created[k]]
+            for f in key_filters('_id', [(i,) for i in ids]):
+                self.refresh_search_tokens(f)
+        return [r if r is not None else created[tuple(sorted(c.items()))] for c, r in zip(conds, rs)]
+
+    def random_find(self, cond={}, count=10, fields=None, strategy=None):
+        """
+        strategy: 'sample'用$match+$sample; 'random_key'按random_field索引随机取, 需先backfill_random_key;
+        默认在设置了random_field时, 集合或命中文档数不超过random_sample_threshold用$sample, 否则用random_key
+        """
+        if strategy is None:
+            strategy = self.choose_random_strategy(cond)
+        if strategy == 'random_key':
+            return self.random_key_find(cond, count, fields)
+        return self.aggregate(self._random_find_pipeline(cond, count, fields), op='random_find')
+
+    def choose_random_strategy(self, cond={}):
+        if not self.random_field:
+            return 'sample'
+        limit = self.random_sample_threshold
+        if self.collection.estimated_document_count() <= limit:
+            return 'sample'
         cond = self.normalize_filter(cond)
-        fs = [{'$match': cond}, {'$sample': {'size': count}}]
-        if fields:
-            fs.append({'$project': fields})
-        return self.collection.aggregate(fs)
+        if not cond:
+            return 'sample'
+        # 命中文档少时$match走条件索引后再$sample更快, 命中多时按随机键扫描很快就能凑够
+        return 'random_key' if self.collection.count_documents(cond, limit=limit) >= limit else 'sample'
+
+    def random_key_find(self, cond={}, count=10, fields=None, probes=10):
+        """
+        在random_field上取probes个随机起点, 每个起点顺序取count/probes条, 不足时从头回绕;
+        各起点取到的文档有重叠凑不够count条时, 再排除已取到的_id补一次, 仍不够说明命中的文档已取完
+        """
+        cond = self.normalize_filter(cond) or {}
+        rf = self.random_field
+        probes = max(min(probes, count), 1)
+        per = -(-count // probes)
+        pj = dict(normalize_projection(fields) or {})
+        hide_id = pj.pop('_id', 1) == 0
+        rs = {}
+
+        def take(r, need, exclude=None):
+            for op in ['$gte', '$lt']:
+                cs = [cond, {rf: {op: r}}] + ([{'_id': {'$nin': exclude}}] if exclude else [])
+                ds = list(self.collection.find({'$and': cs}, pj or None, sort=[(rf, 1)], limit=need))
+                for d in ds:
+                    rs.setdefault(d['_id'], d)
+                need -= len(ds)
+                if need <= 0:
+                    break
+
+        for i in range(probes):
+            take(random.random(), per)
+            if len(rs) >= count:
+                break
+        if len(rs) < count:
+            take(random.random(), count - len(rs), list(rs))
+        ds = list(rs.values())[:count]
+        if hide_id:
+            for d in ds:
+                d.pop('_id', None)
+        return ds
+
+    def backfill_random_key(self, batch_size=1000, checkpoint=None, max_rate=None, index_keys=[]):
+        """
+        给没有random_field的文档补上随机值, 并建立 index_keys + [random_field] 索引
+        """
+        rf = self.random_field
+        r = self.batch_update([{'$set': {rf: {'$rand': {}}}}], {rf: {'$exists': False}}, batch_size=batch_size,
+                              checkpoint=checkpoint, max_rate=max_rate)
+        self.collection.create_index([(k, 1) for k in index_keys] + [(rf, 1)])
+        return r
 
     def find(self, filter=None, projection=None, **kwargs):
         filter = self.normalize_filter(filter)
         if 'sort' not in kwargs:
             ordering = kwargs.pop('ordering', self.ordering)
             kwargs['sort'] = [ordering_to_sort(s) for s in ordering]
-        if isinstance(projection, (list, tuple, set)):
-            projection = dict([(a, 1) for a in projection])
-            if '_id' not in projection:
-                projection['_id'] = 0
+        projection = normalize_projection(projection)
+        self._record_query(filter, kwargs['sort'])
+        start = time.time()
         rs = self.collection.find(filter, projection,  **kwargs)
         if not hasattr(rs, 'count'):
             setattr(rs, 'count', lambda: self.count(filter))
+        if self.instrument:
+            sort = kwargs['sort']
+            explain = lambda: self.collection.find(filter or {}, sort=sort or None).explain()
+            rs = InstrumentedCursor(rs, self, 'find', filter, start, explain)
         return rs
 
+    def aggregate(self, pipeline, op='aggregate', **kwargs):
+        if not self.instrument:
+            return self.collection.aggregate(pipeline, **kwargs)
+        start = time.time()
+        rs = self.collection.aggregate(pipeline, **kwargs)
+        explain = lambda: self.db.command('explain', {'aggregate': self.collection.name, 'pipeline': pipeline,
+                                                      'cursor': {}}, verbosity='queryPlanner')
+        return InstrumentedCursor(rs, self, op, pipeline_filter(pipeline), start, explain)
+
+    def _timed(self, op, filter, func, *args, **kwargs):
+        if not self.instrument:
+            return func(*args, **kwargs)
+        start = time.time()
+        r = func(*args, **kwargs)
+        self.instrument.observe(self, op, filter, start, docs=result_docs(r),
+                                explain=lambda: self.collection.find(filter or {}).explain())
+        return r
+
+    def keyset_find(self, filter=None, projection=None, sort=None, after=None, limit=100):
+        """
+        游标(keyset)分页: 用上一页最后一条的排序键和_id做范围条件, 代替skip.
+        返回 (本页文档, 下一页cursor或None)
+        """
+        filter = self.normalize_filter(filter)
+        sort = list(sort or [ordering_to_sort(s) for s in self.ordering])
+        if '_id' not in [f for f, d in sort]:
+            sort.append(('_id', sort[-1][1] if sort else 1))
+        if isinstance(projection, (list, tuple, set)):
+            projection = dict([(a, 1) for a in projection])
+        if projection:
+            projection = dict(projection)
+            inclusive = any([v for k, v in projection.items() if k != '_id'])
+            for f, d in sort:
+                if inclusive or f == '_id':
+                    projection[f] = 1
+                else:
+                    projection.pop(f, None)
+        if after:
+            kc = keyset_condition(sort, decode_cursor(after))
+            filter = {'$and': [filter, kc]} if filter else kc
+        self._record_query(filter, sort)
+        rs = list(self.collection.find(filter, projection, sort=sort, limit=limit + 1))
+        next = None
+        if len(rs) > limit:
+            rs = rs[:limit]
+            next = encode_cursor([access(rs[-1], f) for f, d in sort])
+        return rs, next
+
+    def export(self, output, format='ndjson', filter=None, projection=None, sort=None, batch_size=10000, raw=False,
+               progress=None, columns=None):
+        """
+        流式导出到ndjson/csv/parquet, output可以是文件路径或文件对象(parquet需二进制).
+        按batch_size条一批从游标读取并写出, 内存只占一批; raw=True时游标返回RawBSONDocument, 只支持ndjson.
+        csv/parquet的列须事先确定: columns(嵌套字段用a.b), 或projection里包含的字段; 文档里出现列以外的字段时报错.
+        parquet的列类型取自schema(_fields), 未知类型的列按字符串写出.
+        progress(rows, rows_per_sec)每批回调一次. 返回 {rows, seconds, rows_per_sec}
+        """
+        if raw and format != 'ndjson':
+            raise ValueError('raw export only supports ndjson')
+        projection = normalize_projection(projection)
+        if columns is None and projection and any(projection.values()):
+            columns = [k for k, v in projection.items() if v]
+            if '_id' not in projection:
+                columns.insert(0, '_id')
+        elif columns and not projection:
+            projection = dict([(c, 1) for c in columns])
+            if '_id' not in columns:
+                projection['_id'] = 0
+        if format != 'ndjson' and not columns:
+            raise ValueError('%s export needs columns or an inclusive projection' % format)
+        types = dict([(c, self._fields.get(c)) for c in columns]) if format == 'parquet' else None
+        collection = self.collection
+        if raw:
+            from bson.codec_options import CodecOptions
+            from bson.raw_bson import RawBSONDocument
+            collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        filter = self.normalize_filter(filter)
+        sort = sort or [ordering_to_sort(s) for s in self.ordering]
+        self._record_query(filter, sort)
+        cursor = collection.find(filter, projection, sort=sort, batch_size=batch_size)
+        writer = EXPORT_WRITERS[format](output, columns, types)
+        start = time.time()
+        rows = 0
+        try:
+            for ds in split_chunks(cursor, batch_size):
+                writer.write(ds)
+                rows += len(ds)
+                rate = rows / max(time.time() - start, 1e-6)
+                if progress:
+                    progress(rows, rate)
+                else:
+                    log.info('export %s: %d rows, %.0f rows/s', self.name, rows, rate)
+        finally:
+            writer.close()
+        seconds = time.time() - start
+        return dict(rows=rows, seconds=seconds, rows_per_sec=rows / max(seconds, 1e-6))
+
+    def to_dataframe(self, filter=None, projection=None, dtypes=None, chunksize=None, batch_size=10000, sort=None):
+        """
+        按游标批次把文档直接拆到列缓冲区里再建DataFrame, 嵌套字段展开成a.b列名.
+        列类型默认按schema(_fields)推断, dtypes可覆盖 {列名: dtype}.
+        chunksize指定时返回迭代器, 每chunksize行一个DataFrame
+        """
+        filter = self.normalize_filter(filter)
+        self._record_query(filter, sort)
+        projection = normalize_projection(projection)
+        cursor = self.collection.find(filter, projection, sort=sort or None, batch_size=batch_size)
+        columns = None
+        if projection and any(projection.values()):
+            columns = [k for k, v in projection.items() if v]
+            if '_id' not in projection:
+                columns.insert(0, '_id')
+        types = dict([(fn, DATAFRAME_DTYPES.get(ft, 'object')) for fn, ft in self._fields.items()])
+        types.update(dtypes or {})
+        frames = iter_dataframes(cursor, columns, types, chunksize)
+        if chunksize:
+            return frames
+        for df in frames:
+            return df
+        import pandas as pd
+        return pd.DataFrame(columns=columns)
+
     def search(self, cond, *args, **kwargs):
         # cond = self.normalize_filter(cond)
         return self.find(cond, *args, **kwargs)
 
     def upsert(self, cond, value, **kwargs):
-        d = {'$set': value}
-        for k, v in kwargs.items():
-            d['$%s' % k] = v
-        return self.collection.update_one(cond, d, upsert=True)
-
-    def batch_upsert(self, data_list, key='id', preset=lambda a, i: a, **kwargs):
-        i = -1
-        for i, d in enumerate(data_list):
-            if isinstance(d, tuple):
-                d = d[-1]
-            d = preset(d, i) or d
-            print(d[key])
-            self.upsert({key: d[key]}, d, **kwargs)
-        return i + 1
+        value, refresh = self.add_search_tokens(value)
+        r = self._timed('upsert', cond, self.collection.update_one, cond,
+                        upsert_document(value, random_field=self.random_field, **kwargs), upsert=True)
+        if refresh:
+            self.refresh_search_tokens(cond)
+        return r
+
+    def bulk_write(self, ops, ordered=False):
+        from pymongo.errors import BulkWriteError
+        try:
+            return bulk_write_result(self.collection.bulk_write(ops, ordered=ordered))
+        except BulkWriteError as e:
+            return bulk_write_result(e)
+
+    def batch_upsert(self, data_list, key='id', preset=lambda a, i: a, chunk=1000, workers=0, **kwargs):
+        """
+        按chunk条一组生成UpdateOne, 以bulk_write(ordered=False)写入, workers>0时用线程池并发写入各组.
+        返回 {count, matched, upserted, modified, errors}, errors为[{chunk, errors}]
+        """
+        result = dict(count=0, matched=0, upserted=0, modified=0, errors=[])
+        merge = lambda i, ops, r: merge_bulk_result(result, i, ops, r)
+        refresh = []
+        preset = self._search_token_preset(preset, key, refresh)
+        chunks = enumerate(split_chunks(upsert_operations(data_list, key, preset, random_field=self.random_field,
+                                                          **kwargs), chunk))
+        if not workers:
+            for i, ops in chunks:
+                merge(i, ops, self.bulk_write(ops))
+        else:
+            from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = {}
+                for i, ops in chunks:
+                    if len(pending) >= workers * 2:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            merge(*pending.pop(f), f.result())
+                    pending[executor.submit(self.bulk_write, ops)] = (i, ops)
+                for f in list(pending):
+                    merge(*pending.pop(f), f.result())
+        for f in key_filters(key, refresh, chunk):
+            self.refresh_search_tokens(f)
+        return result
 
     def update(self, cond, value, **kwargs):
         cond = self.normalize_filter(cond)
+        refresh = False
         d = {}
         if value:
+            value, refresh = self.add_search_tokens(value)
             d['$set'] = value
         for k, v in kwargs.items():
             d['$%s' % k] = v
-        return self.collection.update_many(cond, d)
+        self._record_query(cond)
+        # 更新后cond可能不再命中这些文档(如改的正是条件字段), 先记下_id再按_id补分词
+        ids = [(a['_id'],) for a in self.collection.find(cond, {'_id': 1})] if refresh else []
+        r = self._timed('update', cond, self.collection.update_many, cond, d)
+        for f in key_filters('_id', ids):
+            self.refresh_search_tokens(f)
+        return r
 
     def inc(self, cond, value):
         cond = self.normalize_filter(cond)
-        self.collection.update_many(cond, {'$inc': value}, upsert=True)
+        if self.write_buffer:
+            return self.write_buffer.inc(self.collection, cond, value, random_field=self.random_field)
+        self.collection.update_many(cond, set_on_insert_random({'$inc': value}, self.random_field, value), upsert=True)
 
     def add_to_set(self, cond, value):
         cond = self.normalize_filter(cond)
-        self.collection.update_many(cond, {'$addToSet': value}, upsert=True)
-
-    def count(self, filter=None, distinct=False):
+        if self.write_buffer:
+            return self.write_buffer.add_to_set(self.collection, cond, value, random_field=self.random_field)
+        self.collection.update_many(cond, set_on_insert_random({'$addToSet': value}, self.random_field, value),
+                                    upsert=True)
+
+    def count(self, filter=None, distinct=False, cache_ttl=None, limit=None, approximate=False):
+        """
+        cache_ttl: 按规范化后的filter缓存计数的秒数, 默认取count_cache_ttl
+        limit: 最多精确数到limit条, 达到上限时返回EstimatedCount, 显示为"N+"
+        approximate: 配合distinct使用, 用HyperLogLog估算不同值个数, 为整数时作为precision
+        """
+        if distinct and approximate:
+            precision = 14 if approximate is True else approximate
+            return self.distinct_sketch(distinct, filter, precision=precision).count()
         filter = self.normalize_filter(filter)
+        ttl = self.count_cache_ttl if cache_ttl is None else cache_ttl
+        limit = self.count_limit if limit is None else limit
+        self._record_query(filter)
+        if not ttl:
+            return self._timed('count', filter, self._count, filter, distinct, limit)
+        key = (self.db.name, self.name, json_util.dumps(filter, sort_keys=True), distinct, limit)
+        r = cache_get(COUNT_CACHE, key)
+        if r is None:
+            r = self._timed('count', filter, self._count, filter, distinct, limit)
+            cache_set(COUNT_CACHE, key, r, ttl, COUNT_CACHE_SIZE)
+        return r
+
+    def _count(self, filter, distinct=False, limit=None):
         if distinct:
-            gs = []
-            if filter:
-                gs.append({'$match': filter})
-            gs.append({'$group': {'_id': '$%s' % distinct}}),
-            gs.append({'$group': {'_id': 0, 'count': {'$sum': 1}}})
-            for a in self.collection.aggregate(gs):
+            for a in self.collection.aggregate(distinct_count_pipeline(filter, distinct)):
                 return a['count']
             return 0
         if not filter:
             return self.collection.estimated_document_count()
+        if limit:
+            n = self.collection.count_documents(filter, limit=limit)
+            return EstimatedCount(n) if n >= limit else n
         return self.collection.count_documents(filter)
 
+    def distinct_sketch(self, field, filter=None, precision=14, batch_size=10000):
+        """
+        流式读取field的值构建HyperLogLog, 数组字段按整个数组计一个值(与$group一致)
+        """
+        filter = self.normalize_filter(filter)
+        self._record_query(filter)
+        h = HyperLogLog(precision)
+        start = time.time()
+        n = 0
+        for d in self.collection.find(filter, {field: 1, '_id': 0}, batch_size=batch_size):
+            v = access(d, field)
+            if v is not None:
+                h.add(v)
+            n += 1
+        if self.instrument:
+            self.instrument.observe(self, 'distinct_sketch', filter, start, docs=n)
+        return h
+
+    def save_distinct_sketch(self, field, bucket, sketch):
+        """
+        把sketch按寄存器取max合并进XYZ_STORE_SKETCH里(collection, field, bucket, precision)对应的文档, 服务端原子完成;
+        不同precision的寄存器个数不同不能合并, 各存一份
+        """
+        new = list(sketch.registers)
+        merged = {'$map': {'input': {'$range': [0, sketch.m]}, 'as': 'i',
+                           'in': {'$max': [{'$arrayElemAt': [{'$ifNull': ['$registers', []]}, '$$i']},
+                                           {'$arrayElemAt': [new, '$$i']}]}}}
+        return Store(name=SKETCH_META).collection.update_one(
+            {'collection': self.name, 'field': field, 'bucket': bucket, 'precision': sketch.precision},
+            [{'$set': {'registers': merged}}],
+            upsert=True)
+
+    def add_distinct_values(self, field, bucket, values, precision=14):
+        h = HyperLogLog(precision)
+        h.update(values)
+        return self.save_distinct_sketch(field, bucket, h)
+
+    def build_distinct_sketch(self, field, bucket, filter=None, precision=14):
+        return self.save_distinct_sketch(field, bucket, self.distinct_sketch(field, filter, precision=precision))
+
+    def load_distinct_sketch(self, field, buckets, precision=14):
+        """
+        buckets: 桶名列表, 或范围条件如 {'$gte': '2024-01-01', '$lte': '2024-01-31'}; 合并后返回HyperLogLog
+        """
+        cond = {'collection': self.name, 'field': field, 'precision': precision}
+        cond['bucket'] = {'$in': list(buckets)} if isinstance(buckets, (list, tuple, set)) else buckets
+        h = HyperLogLog(precision)
+        for d in Store(name=SKETCH_META).collection.find(cond, {'registers': 1}):
+            h.merge(HyperLogLog(precision, d['registers']))
+        return h
+
+    def split_points(self, key='_id', partitions=8, filter=None, method='sample', sample_size=None):
+        """
+        把集合按key切成partitions段, 返回段之间的分界值.
+        method='sample'用$sample抽样取分位点(默认, 每段抽100条); 'bucket_auto'用$bucketAuto精确切分, 需全表扫描
+        """
+        filter = self.normalize_filter(filter)
+        if partitions <= 1:
+            return []
+        ps = [{'$match': filter}] if filter else []
+        if method == 'bucket_auto':
+            ps.append({'$bucketAuto': {'groupBy': f'${key}', 'buckets': partitions}})
+            return [b['_id']['min'] for b in list(self.collection.aggregate(ps, allowDiskUse=True))[1:]]
+        ps += [{'$sample': {'size': sample_size or partitions * 100}}, {'$project': {'_id': 0, 'k': f'${key}'}}]
+        vs = sorted([a['k'] for a in self.collection.aggregate(ps, allowDiskUse=True) if a.get('k') is not None])
+        if not vs:
+            return []
+        return list(dict.fromkeys([vs[len(vs) * i // partitions] for i in range(1, partitions)]))
+
+    def partition_conditions(self, key='_id', partitions=8, filter=None, method='sample'):
+        filter = self.normalize_filter(filter)
+        points = self.split_points(key, partitions, filter, method=method)
+        bounds = [None] + points + [None]
+        rs = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            c = {}
+            if lo is not None:
+                c['$gte'] = lo
+            if hi is not None:
+                c['$lt'] = hi
+            c = {key: c} if c else {}
+            if lo is None and c and key != '_id':
+                # null/缺失的key排在所有值之前, 归入第一段
+                c = {'$or': [c, {key: None}]}
+            if filter:
+                c = {'$and': [filter, c]} if c else filter
+            rs.append(c)
+        return rs
+
+    def parallel_scan(self, mapper, reducer=None, filter=None, key='_id', partitions=None, method='sample', workers=None,
+                      processes=False):
+        """
+        按key分段并行执行mapper(store, cond), 再用reducer(a, b)依次合并各段结果; 没有reducer时按段顺序返回结果列表.
+        processes=True时用进程池, mapper和reducer需可pickle, 子进程里按(store类, server, db, name)重建store
+        """
+        import functools
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        workers = workers or os.cpu_count() or 4
+        conds = self.partition_conditions(key, partitions or workers, filter, method=method)
+        if processes:
+            spec = (type(self), self.server, self.db.name, self.name)
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            spec = self
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            rs = list(executor.map(functools.partial(run_partition, spec, mapper), conds))
+        if reducer is None:
+            return rs
+        return functools.reduce(reducer, rs)
+
+    def parallel_find(self, mapper, reducer=None, filter=None, projection=None, **kwargs):
+        """
+        每段一个find游标, mapper(cursor)返回该段的部分结果
+        """
+        import functools
+        return self.parallel_scan(functools.partial(find_partition, mapper, normalize_projection(projection)),
+                                  reducer, filter, **kwargs)
+
+    def parallel_aggregate(self, pipeline, reducer=None, filter=None, **kwargs):
+        """
+        每段在pipeline前加上该段的$match分别聚合; 默认把各段结果列表拼接起来
+        """
+        import functools
+        reducer = reducer or (lambda a, b: a + b)
+        return self.parallel_scan(functools.partial(aggregate_partition, pipeline), reducer, filter, **kwargs)
+
+    def facet_find(self, filter=None, projection=None, **kwargs):
+        """
+        返回FacetQuery, 分页时用一次$facet聚合同时取回当页结果和总数
+        """
+        filter = self.normalize_filter(filter)
+        sort = kwargs.get('sort') or [ordering_to_sort(s) for s in kwargs.get('ordering', self.ordering)]
+        self._record_query(filter, sort)
+        return FacetQuery(self, filter, normalize_projection(projection), sort)
+
     def sum(self, field, filter=None):
         filter = self.normalize_filter(filter)
+        self._record_query(filter)
         gs = []
         if filter:
             gs.append({'$match': filter})
         gs.append({'$group': {'_id': 0, 'result': {'$sum': '$%s' % field}}})
-        for a in self.collection.aggregate(gs):
-            return a['result']
+        rs = list(self.aggregate(gs, op='sum'))
+        return rs[0]['result'] if rs else None
 
     def count_by(self, field, output='dict', **kwargs):
         rs = self.group_by(field, **kwargs)
@@ -227,68 +924,1071 @@ class Store(object):
         return rs
 
     def group_by(self, field, aggregate={'count': {'$sum': 1}}, filter=None, unwind=False, prepare=[]):
-        filter = self.normalize_filter(filter)
-        ps = []+ prepare
-        if filter:
-            ps.append({'$match': filter})
-        if unwind:
-            ps.append({'$unwind': '$%s' % field})
-        if isinstance(field, str):
-            exp = '$%s' % field
-        elif isinstance(field, (list,tuple)):
-            exp= dict([(f, f'${f}') for f in field])
+        if self.rollups and not unwind and not prepare:
+            cond = self.normalize_filter(filter)
+            for r in self.rollups:
+                if r.covers(field, aggregate, cond):
+                    return r.group_by(field, aggregate, cond)
+        return self.aggregate(self._group_by_pipeline(field, aggregate, filter, unwind, prepare), op='group_by')
+
+    def server_version(self):
+        key = ('server_version', id(self.db.client))
+        r = cache_get(SCHEMA_CACHE, key)
+        if r is None:
+            r = tuple(self.db.client.server_info()['versionArray'][:2])
+            cache_set(SCHEMA_CACHE, key, r, self.schema_cache_ttl or SCHEMA_CACHE_TTL, SCHEMA_CACHE_SIZE)
+        return r
+
+    def time_series(self, field, interval='day', measures={'count': {'$sum': 1}}, filter=None, tz=None,
+                    start=None, end=None, bin_size=1, fill=0):
+        """
+        按时间分桶统计, 返回画图用的稠密数组 {'buckets': [datetime, ...], 'count': [...]}, 没有数据的时间段补fill.
+        interval: minute/hour/day/week(周一开始)/month/quarter/year, tz如'Asia/Shanghai'或'+08:00', buckets为UTC时间.
+        MongoDB>=5.0用$dateTrunc, >=5.1时由$densify补空(带时区的天以上粒度在客户端补), 更老的版本退回$dateToString.
+        rollups里有相同date_trunc维度和measures的预聚合时直接从预聚合表汇总.
+        """
+        if interval not in TIME_UNITS:
+            raise ValueError('time_series interval must be one of %s' % TIME_UNITS)
+        measures = group_aggregate(measures)
+        exp = date_trunc(field, interval, tz, bin_size)
+        tzinfo = get_tzinfo(tz)
+        cond = self.normalize_filter(filter) or {}
+        rs = None
+        for r in self.rollups:
+            if r.covers(exp, measures, cond):
+                rs = [a for a in r.group_by(exp, measures, cond)
+                      if a['_id'] and time_bucket_overlaps(a['_id'], interval, bin_size, tzinfo, start, end)]
+                break
+        densified = False
+        if rs is None:
+            rng = dict([(k, v) for k, v in [('$gte', start), ('$lte', end)] if v])
+            if rng:
+                cond = {'$and': [cond, {field: rng}]} if cond else {field: rng}
+            self._record_query(cond)
+            ps = [{'$match': cond}] if cond else []
+            version = self.server_version()
+            if version >= (5, 0):
+                d = {'_id': exp}
+                d.update(measures)
+                ps.append({'$group': d})
+                if version >= (5, 1) and (not tz or interval in ('minute', 'hour')):
+                    ps.append({'$densify': {'field': '_id', 'range': {'step': bin_size, 'unit': interval, 'bounds': 'full'}}})
+                    densified = True
+                ps.append({'$sort': {'_id': 1}})
+                rs = [a for a in self.aggregate(ps, op='time_series') if a['_id']]
+            else:
+                if interval == 'quarter' or bin_size != 1:
+                    raise ValueError('time_series by %s %s requires MongoDB 5.0' % (bin_size, interval))
+                e = {'format': TIME_BUCKET_FORMATS[interval], 'date': f"${field}"}
+                if tz:
+                    e['timezone'] = tz
+                d = {'_id': {'$dateToString': e}}
+                d.update(measures)
+                ps.append({'$group': d})
+                rs = [a for a in self.aggregate(ps, op='time_series') if a['_id']]
+                for a in rs:
+                    a['_id'] = parse_time_bucket(a['_id'], interval, tzinfo)
+        for a in rs:
+            a['_id'] = naive_utc(a['_id'])
+        rs.sort(key=lambda a: a['_id'])
+        buckets = densify_time_buckets([a['_id'] for a in rs], interval, bin_size, tzinfo, start, end,
+                                       gaps=not densified)
+        m = dict([(a['_id'], a) for a in rs])
+        r = {'buckets': buckets}
+        for n in measures:
+            r[n] = [m[b].get(n, fill) if b in m else fill for b in buckets]
+        return r
+
+    def get_search_backend(self):
+        """
+        search参数的查询方式: 'regex', 'text'($text索引)或'ngram'(分词数组索引, 适合中文).
+        search_backend为None时按集合已有的索引自动选择, 结果缓存schema_cache_ttl秒
+        """
+        if self.search_backend:
+            return self.search_backend
+        key = ('search_backend', self.db.name, self.name)
+        r = cache_get(SCHEMA_CACHE, key)
+        if r is None:
+            r = search_backend_from_indexes(self.collection.index_information())
+            cache_set(SCHEMA_CACHE, key, r, self.schema_cache_ttl or SCHEMA_CACHE_TTL, SCHEMA_CACHE_SIZE)
+        return r
+
+    def create_search_index(self, backend='ngram', batch_size=1000, **kwargs):
+        if backend == 'text':
+            r = self.collection.create_index([(f, 'text') for f in self.search_fields],
+                                             default_language=kwargs.pop('default_language', 'none'), **kwargs)
         else:
-            exp = field
-        d = {'_id': exp}
-        if isinstance(aggregate, (list, tuple)):
-            aggregate = dict([(f, {'$sum': f'${f}'}) for f in aggregate])
-        d.update(aggregate)
-        ps.append({'$group': d})
-        rs = self.collection.aggregate(ps)
-        return rs
-
-    def clean_data(self, data):
-        d = {}
-        for a in data.keys():
-            if self._fields and a not in self._fields:
-                continue
-            d[a] = data[a]
-
-        for t, fs in self.field_types.items():
-            for f in fs:
-                if f in d:
-                    d[f] = t(d[f])
-        return d
-
-    def normalize_filter(self, data, cast=False):
-        if not data:
-            return data
-        fs = self._fields if cast else None
-        fm = self._field_type_map if cast else {}
-        # print(fm, fs)
-        return normalize_filter_condition(data, fm , fs, self.search_fields) #
+            r = self.collection.create_index([(SEARCH_TOKENS_FIELD, 1)], **kwargs)
+            self.refresh_search_tokens(batch_size=batch_size)
+        SCHEMA_CACHE.pop(('search_backend', self.db.name, self.name), None)
+        return r
+
+    def refresh_search_tokens(self, filter=None, batch_size=1000):
+        n = 0
+        ps = dict([(f, 1) for f in self.search_fields])
+        for ds in split_chunks(self.collection.find(filter or {}, ps, batch_size=batch_size), batch_size):
+            ops = search_token_operations(ds, self.search_fields)
+            self.collection.bulk_write(ops, ordered=False)
+            n += len(ops)
+        return n
 
     def create_index(self):
-        for i in self.keys:
+        for i in getattr(self, 'keys', []):
             self.collection.create_index([(i, 1)])
 
+    def suggest_indexes(self, explain=True):
+        """
+        根据记录下来的查询形状给出复合索引建议(等值字段, 排序字段, 范围字段).
+        explain=True时只对explain()显示走COLLSCAN的查询给出建议
+        """
+        existing = [list(a['key']) for a in self.collection.index_information().values()]
+        rs = []
+        for a in QUERY_SHAPES.get((self.db.name, self.name), {}).values():
+            keys = index_keys_for_shape(a['shape'], a['sort'])
+            if not keys or keys in rs:
+                continue
+            if any([ik[:len(keys)] == keys for ik in existing]):
+                continue
+            if explain:
+                cursor = self.collection.find(a['filter'])
+                if a['sort']:
+                    cursor = cursor.sort(a['sort'])
+                if not plan_has_stage(cursor.explain().get('queryPlanner', {}).get('winningPlan', {}), 'COLLSCAN'):
+                    continue
+            rs.append(keys)
+        return [a for a in rs if not any([b != a and b[:len(a)] == a for b in rs])]
+
+    def apply_index_suggestions(self, suggestions=None, **kwargs):
+        suggestions = self.suggest_indexes() if suggestions is None else suggestions
+        return [self.collection.create_index(keys, **kwargs) for keys in suggestions]
+
     def eval_foreign_keys(self, d, foreign_keys=None):
+        if not d:
+            return d
+        return self.eval_foreign_keys_batch([d], foreign_keys=foreign_keys)[0]
+
+    def eval_foreign_keys_batch(self, ds, foreign_keys=None, projections=None):
+        """
+        一次性解析一批文档的外键: 每个外键store只用一条$in查询取回所有被引用的文档.
+        projections: {外键字段: 外键文档的projection, 或要取的字段列表}
+        """
+        ds = list(ds)
         fks = foreign_keys or getattr(self, 'foreign_keys', None)
         if not fks:
-            return d
+            return ds
         for kn, sn in fks.items():
-            if kn not in d:
+            refs = []
+            for d in ds:
+                if not d or kn not in d:
+                    continue
+                id = mongo_id_value(d[kn])
+                if id:
+                    refs.append((d, id))
+            if not refs:
                 continue
-            id = mongo_id_value(d[kn])
-            if not id:
+            ids = list(set([ObjectId(id) for d, id in refs]))
+            pj = (projections or {}).get(kn)
+            pj = dict([(f, 1) for f in pj]) if isinstance(pj, (list, tuple)) else pj or None
+            m = dict([(text_type(a['_id']), a) for a in Store(name=sn).collection.find({'_id': {'$in': ids}}, pj)])
+            for d, id in refs:
+                d[kn] = m.get(id)
+        return ds
+
+    def change_field_type(self, type_map, filter={}, batch_size=None, checkpoint=None, max_rate=None):
+        """
+        type_map: {字段: 转换操作符名}, 如 {'age': 'toInt'}.
+        指定batch_size时按_id分段批量转换, 可断点续跑, 见batch_update
+        """
+        cond = self.normalize_filter(filter)
+        ps = [{'$set': {k:{f'${v}': f'${k}'}}} for k, v in type_map.items()]
+        if not batch_size:
+            return self.collection.update_many(cond, ps)
+        if checkpoint is None:
+            checkpoint = '%s.change_field_type:%s:%s' % (self.name, json_util.dumps(type_map, sort_keys=True),
+                                                        json_util.dumps(cond or {}, sort_keys=True))
+        return self.batch_update(ps, cond, batch_size=batch_size, checkpoint=checkpoint, max_rate=max_rate)
+
+    def batch_update(self, update, filter=None, batch_size=1000, checkpoint=None, max_rate=None):
+        """
+        按_id升序分段执行update_many, 每段batch_size条.
+        checkpoint: 断点名, 每段完成后把最后的_id记录到XYZ_STORE_MIGRATION, 重跑时从断点继续;
+            已完成的断点重跑时只处理last_id之后新增的文档, 断点名应包含filter等区分这次更新的信息
+        max_rate: 每秒最多处理的文档数
+        返回 {matched, modified, batches, last_id, done}, 计数为该断点历次运行的累计值
+        """
+        filter = self.normalize_filter(filter)
+        meta = Store(name=MIGRATION_META).collection if checkpoint else None
+        state = dict(matched=0, modified=0, batches=0, last_id=None, done=False)
+        if checkpoint:
+            state.update((meta.find_one({'name': checkpoint}, {'_id': 0, 'name': 0}) or {}))
+            state['done'] = False
+        start = time.time()
+        processed = 0
+        while True:
+            cond = {'_id': {'$gt': state['last_id']}} if state['last_id'] is not None else {}
+            if filter:
+                cond = {'$and': [filter, cond]} if cond else filter
+            ids = [a['_id'] for a in self.collection.find(cond, {'_id': 1}, sort=[('_id', 1)], limit=batch_size)]
+            if not ids:
+                state['done'] = True
+            else:
+                rg = {'_id': {'$gte': ids[0], '$lte': ids[-1]}}
+                r = self.collection.update_many({'$and': [filter, rg]} if filter else rg, update)
+                state['matched'] += r.matched_count
+                state['modified'] += r.modified_count
+                state['batches'] += 1
+                state['last_id'] = ids[-1]
+                processed += len(ids)
+            if checkpoint:
+                meta.update_one({'name': checkpoint}, {'$set': state}, upsert=True)
+            if state['done']:
+                return state
+            if max_rate:
+                wait = processed / max_rate - (time.time() - start)
+                if wait > 0:
+                    time.sleep(wait)
+
+
+RANGE_OPERATORS = ['$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$not', '$exists', '$regex', '$type', '$size']
+
+
+def filter_shape(filter):
+    """
+    把filter归纳成 {字段: 'eq'|'range'}, $and展开合并, $or/$nor等逻辑分支忽略
+    """
+    d = {}
+    for k, v in (filter or {}).items():
+        if k == '$and':
+            for a in v:
+                for f, t in filter_shape(a).items():
+                    d[f] = 'eq' if d.get(f) == 'eq' else t
+            continue
+        if k.startswith('$'):
+            continue
+        if isinstance(v, dict) and any([op in RANGE_OPERATORS for op in v]):
+            d[k] = 'range'
+        else:
+            d[k] = 'eq'
+    return d
+
+
+def record_query_shape(db, collection, filter, sort=None):
+    shape = filter_shape(filter)
+    sort = [tuple(a) for a in sort or []]
+    if not shape and not sort:
+        return
+    shapes = QUERY_SHAPES.setdefault((db, collection), {})
+    key = (tuple(sorted(shape.items())), tuple(sort))
+    a = shapes.get(key)
+    if a is None:
+        if len(shapes) >= QUERY_SHAPES_SIZE:
+            return
+        a = shapes[key] = dict(shape=shape, sort=sort, count=0)
+    a['count'] += 1
+    a['filter'] = filter or {}
+
+
+def index_keys_for_shape(shape, sort=None):
+    keys = [(f, 1) for f, t in shape.items() if t == 'eq' and f != '_id']
+    fs = [f for f, d in keys]
+    for f, d in sort or []:
+        if f not in fs:
+            keys.append((f, d))
+            fs.append(f)
+    keys += [(f, 1) for f, t in shape.items() if t == 'range' and f not in fs]
+    return keys
+
+
+def plan_has_stage(plan, stage):
+    if not isinstance(plan, dict):
+        return False
+    if plan.get('stage') == stage:
+        return True
+    for k in ['inputStage', 'queryPlan']:
+        if plan_has_stage(plan.get(k), stage):
+            return True
+    return any([plan_has_stage(a, stage) for a in plan.get('inputStages', [])])
+
+
+class WriteBuffer(object):
+    """
+    Store.inc/add_to_set的写缓冲: 按(collection, filter)合并$inc和$addToSet, 攒够max_size组或每隔interval秒
+    由后台线程用一次bulk_write写入; 退出with块时写入一次, 进程结束时关闭并写入.
+    待写组数达到max_pending时, 调用方同步写入(背压). 写入失败的组放回缓冲区, 重试max_retries次后丢弃.
+
+        buffer = WriteBuffer(max_size=500, interval=2)
+        PageViews.write_buffer = buffer
+    """
+
+    def __init__(self, max_size=1000, interval=1.0, max_pending=100000, max_retries=3):
+        import atexit
+        self.max_size = max_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.metrics = dict(flushes=0, ops=0, errors=0, requeued=0, dropped=0, last_batch_size=0, max_batch_size=0,
+                            last_flush_ms=0, max_flush_ms=0, total_flush_ms=0)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _start(self):
+        if self._thread or not self.interval:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mongo-write-buffer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('WriteBuffer flush failed')
+
+    def _entry(self, collection, filter, key=None, random_field=None):
+        key = key or (collection.full_name, json_util.dumps(filter, sort_keys=True))
+        a = self.pending.get(key)
+        if a is None:
+            a = self.pending[key] = dict(collection=collection, filter=filter, inc={}, add_to_set={}, retries=0,
+                                         random_field=random_field)
+        return a
+
+    def _merge(self, a, inc={}, add_to_set={}):
+        for k, v in inc.items():
+            a['inc'][k] = a['inc'].get(k, 0) + v
+        for k, v in add_to_set.items():
+            vs = a['add_to_set'].setdefault(k, [])
+            for b in (v['$each'] if isinstance(v, dict) and '$each' in v else [v]):
+                if b not in vs:
+                    vs.append(b)
+
+    def _add(self, collection, filter, op, value, random_field=None):
+        with self.lock:
+            self._merge(self._entry(collection, filter, random_field=random_field), **{op: value})
+            size = len(self.pending)
+            self._start()
+        if size >= self.max_pending or (size >= self.max_size and not self._thread):
+            self.flush()
+        elif size >= self.max_size:
+            self._wake.set()
+
+    def _requeue(self, failed):
+        with self.lock:
+            for key, a in failed:
+                if a['retries'] >= self.max_retries:
+                    self.metrics['dropped'] += 1
+                    log.error('WriteBuffer dropped %s %s after %d retries', key[0], a['filter'], a['retries'])
+                    continue
+                b = self._entry(a['collection'], a['filter'], key, a['random_field'])
+                b['retries'] = max(b['retries'], a['retries'] + 1)
+                self._merge(b, a['inc'], dict([(k, {'$each': vs}) for k, vs in a['add_to_set'].items()]))
+                self.metrics['requeued'] += 1
+
+    def inc(self, collection, filter, value, random_field=None):
+        self._add(collection, filter, 'inc', value, random_field)
+
+    def add_to_set(self, collection, filter, value, random_field=None):
+        self._add(collection, filter, 'add_to_set', value, random_field)
+
+    def flush(self):
+        from pymongo import UpdateMany
+        from pymongo.errors import BulkWriteError
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return 0
+            start = time.time()
+            groups = {}
+            for key, a in pending.items():
+                d = {}
+                if a['inc']:
+                    d['$inc'] = a['inc']
+                if a['add_to_set']:
+                    d['$addToSet'] = dict([(k, {'$each': vs}) for k, vs in a['add_to_set'].items()])
+                set_on_insert_random(d, a['random_field'], dict(a['inc'], **a['add_to_set']))
+                c = a['collection']
+                g = groups.setdefault(c.full_name, (c, [], []))
+                g[1].append(UpdateMany(a['filter'], d, upsert=True))
+                g[2].append(key)
+            failed = []
+            for c, ops, keys in groups.values():
+                try:
+                    c.bulk_write(ops, ordered=False)
+                    continue
+                except BulkWriteError as e:
+                    # unordered: only the reported ops failed, the rest are applied and must not be replayed
+                    ks = [keys[w['index']] for w in e.details.get('writeErrors', [])]
+                except Exception:
+                    ks = keys
+                self.metrics['errors'] += 1
+                log.exception('WriteBuffer bulk_write to %s failed', c.full_name)
+                failed += [(k, pending[k]) for k in ks]
+            if failed:
+                self._requeue(failed)
+            ms = (time.time() - start) * 1000
+            m = self.metrics
+            m['flushes'] += 1
+            m['ops'] += len(pending)
+            m['last_batch_size'] = len(pending)
+            m['max_batch_size'] = max(m['max_batch_size'], len(pending))
+            m['last_flush_ms'] = ms
+            m['max_flush_ms'] = max(m['max_flush_ms'], ms)
+            m['total_flush_ms'] += ms
+            return len(pending)
+
+    def close(self):
+        """
+        停止后台线程并写入剩余数据; 之后再有写入会重新启动后台线程
+        """
+        t = self._thread
+        if t:
+            self._stop.set()
+            self._wake.set()
+            if t is not threading.current_thread():
+                t.join(self.interval + 5)
+            self._thread = None
+        self.flush()
+
+
+def flatten_document(d, prefix=''):
+    r = {}
+    for k, v in d.items():
+        fn = '%s%s' % (prefix, k)
+        if isinstance(v, dict):
+            r.update(flatten_document(v, prefix='%s.' % fn))
+        else:
+            r[fn] = v
+    return r
+
+
+def export_value(v):
+    if v is None or isinstance(v, (bool, int, float, text_type)):
+        return v
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    if isinstance(v, (list, tuple)):
+        return json_util.dumps(v)
+    return text_type(v)
+
+
+DATAFRAME_DTYPES = {
+    'integer': 'Int64',
+    'number': 'float64',
+    'boolean': 'boolean',
+    'datetime': 'datetime64[ns]',
+    'string': 'string',
+}
+
+
+def iter_dataframes(docs, columns=None, dtypes={}, chunksize=None):
+    """
+    把文档流按列追加到缓冲区, 每chunksize行(为None时全部)生成一个DataFrame, 不生成中间的行字典列表
+    """
+    import pandas as pd
+
+    def build(buffers, n):
+        data = {}
+        for c, vs in buffers.items():
+            if not any([v is not None for v in vs]) and any([k.startswith(c + '.') for k in buffers]):
+                # 投影里的子文档字段已展开成a.b列, 不再留一列全空的a
                 continue
-            d[kn] = Store(name=sn).get(id)
+            if len(vs) < n:
+                vs += [None] * (n - len(vs))
+            dt = dtypes.get(c, 'object')
+            if dt == 'object':
+                vs = [text_type(v) if isinstance(v, ObjectId) else v for v in vs]
+            try:
+                data[c] = pd.array(vs, dtype=dt) if dt != 'datetime64[ns]' else pd.to_datetime(vs)
+            except (TypeError, ValueError):
+                data[c] = pd.array(vs, dtype='object')
+        return pd.DataFrame(data, columns=list(data.keys()))
+
+    allowed = {}
+
+    def is_allowed(c):
+        if c not in allowed:
+            allowed[c] = any([c == p or c.startswith(p + '.') for p in columns])
+        return allowed[c]
+
+    buffers = dict([(c, []) for c in columns or []])
+    n = 0
+    for d in docs:
+        row = flatten_document(d)
+        for c, v in row.items():
+            vs = buffers.get(c)
+            if vs is None:
+                if columns is not None and not is_allowed(c):
+                    continue
+                vs = buffers[c] = []
+            if len(vs) < n:
+                vs += [None] * (n - len(vs))
+            vs.append(v)
+        n += 1
+        if chunksize and n >= chunksize:
+            yield build(buffers, n)
+            buffers = dict([(c, []) for c in buffers])
+            n = 0
+    if n or not chunksize:
+        yield build(buffers, n)
+
+
+class ExportWriter(object):
+
+    def __init__(self, output, columns=None, types=None, mode='w'):
+        self.close_file = isinstance(output, str)
+        if self.close_file:
+            self.file = open(output, mode) if 'b' in mode else open(output, mode, encoding='utf8', newline='')
+        else:
+            self.file = output
+        self.columns = columns or None
+        self.types = types or {}
+
+    def rows(self, ds):
+        cs = set(self.columns)
+        rs = [flatten_document(d) for d in ds]
+        for r in rs:
+            extra = [k for k in r if k not in cs]
+            if extra:
+                raise ValueError('export: fields %s are not in columns %s' % (extra, self.columns))
+        return rs
+
+    def write(self, ds):
+        raise NotImplementedError
+
+    def close(self):
+        if self.close_file:
+            self.file.close()
+
+
+class NDJsonExportWriter(ExportWriter):
+
+    def write(self, ds):
+        self.file.write(''.join([json_util.dumps(d, ensure_ascii=False) + '\n' for d in ds]))
+
+
+class CsvExportWriter(ExportWriter):
+
+    def __init__(self, output, columns, types=None):
+        import csv
+        super(CsvExportWriter, self).__init__(output, columns, types)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+
+    def write(self, ds):
+        self.writer.writerows([[export_value(r.get(c)) for c in self.columns] for r in self.rows(ds)])
+
+
+PARQUET_CASTS = {'integer': int, 'number': float, 'boolean': bool}
+
+
+class ParquetExportWriter(ExportWriter):
+
+    def __init__(self, output, columns, types=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        super(ParquetExportWriter, self).__init__(output, columns, types, mode='wb')
+        tm = {'integer': pa.int64(), 'number': pa.float64(), 'boolean': pa.bool_()}
+        self.schema = pa.schema([(c, tm.get(self.types.get(c), pa.string())) for c in self.columns])
+        self.writer = pq.ParquetWriter(self.file, self.schema)
+
+    def values(self, c, rs):
+        f = PARQUET_CASTS.get(self.types.get(c))
+        vs = [r.get(c) for r in rs]
+        if not f:
+            return [None if v is None else text_type(export_value(v)) for v in vs]
+        rs = []
+        for v in vs:
+            try:
+                rs.append(None if v is None else f(v))
+            except (TypeError, ValueError):
+                raise ValueError('export: column %s is %s in the schema, got %r' % (c, self.types[c], v))
+        return rs
+
+    def write(self, ds):
+        import pyarrow as pa
+        rs = self.rows(ds)
+        self.writer.write_table(pa.Table.from_pydict(dict([(c, self.values(c, rs)) for c in self.columns]),
+                                                     schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        super(ParquetExportWriter, self).close()
+
+
+EXPORT_WRITERS = {
+    'ndjson': NDJsonExportWriter,
+    'csv': CsvExportWriter,
+    'parquet': ParquetExportWriter,
+}
+
+
+def group_expression(field):
+    if isinstance(field, str):
+        return '$%s' % field
+    elif isinstance(field, (list, tuple)):
+        return dict([(f, f'${f}') for f in field])
+    return field
+
+
+def group_aggregate(aggregate):
+    if isinstance(aggregate, (list, tuple)):
+        return dict([(f, {'$sum': f'${f}'}) for f in aggregate])
+    return aggregate
+
+
+TIME_UNITS = ['minute', 'hour', 'day', 'week', 'month', 'quarter', 'year']
+TIME_BUCKET_FORMATS = {
+    'minute': '%Y-%m-%dT%H:%M',
+    'hour': '%Y-%m-%dT%H',
+    'day': '%Y-%m-%d',
+    'week': '%G-%V',
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+
+
+def get_tzinfo(tz):
+    if not tz:
+        return datetime.timezone.utc
+    m = re.match(r'^([+-])(\d{2}):?(\d{2})?$', tz)
+    if m:
+        d = datetime.timedelta(hours=int(m.group(2)), minutes=int(m.group(3) or 0))
+        return datetime.timezone(-d if m.group(1) == '-' else d)
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(tz)
+
+
+def naive_utc(dt):
+    if dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def from_local(dt, tzinfo):
+    return naive_utc(dt.replace(tzinfo=tzinfo))
+
+
+def time_step(dt, unit, n=1, tzinfo=None):
+    """
+    dt(UTC naive)所在桶的起点往后(n<0往前)移n个unit; 天以上按tzinfo的本地日历计算, 跨夏令时也能对齐
+    """
+    if unit in ('minute', 'hour'):
+        return dt + datetime.timedelta(**{unit + 's': n})
+    tzinfo = tzinfo or datetime.timezone.utc
+    local = dt.replace(tzinfo=datetime.timezone.utc).astimezone(tzinfo).replace(tzinfo=None)
+    if unit in ('day', 'week'):
+        local += datetime.timedelta(days=n * (7 if unit == 'week' else 1))
+    else:
+        m = local.year * 12 + local.month - 1 + n * {'month': 1, 'quarter': 3, 'year': 12}[unit]
+        local = local.replace(year=m // 12, month=m % 12 + 1)
+    return from_local(local, tzinfo)
+
+
+def parse_time_bucket(key, unit, tzinfo):
+    fmt = TIME_BUCKET_FORMATS[unit]
+    if unit == 'week':
+        key, fmt = key + '-1', fmt + '-%u'
+    return from_local(datetime.datetime.strptime(key, fmt), tzinfo)
+
+
+def time_bucket_overlaps(bucket, unit, n, tzinfo, start=None, end=None):
+    bucket = naive_utc(bucket)
+    if start and time_step(bucket, unit, n, tzinfo) <= naive_utc(start):
+        return False
+    return not (end and bucket > naive_utc(end))
+
+
+def densify_time_buckets(buckets, unit, n=1, tzinfo=None, start=None, end=None, gaps=True):
+    """
+    在已排序的桶起点之间补上空桶, 并向前/向后补到start/end; 没有任何桶时返回空列表
+    """
+    if not buckets:
+        return []
+    r = []
+    for b in buckets:
+        if gaps and r:
+            x = time_step(r[-1], unit, n, tzinfo)
+            while x < b:
+                r.append(x)
+                x = time_step(x, unit, n, tzinfo)
+        r.append(b)
+    if start:
+        start = naive_utc(start)
+        head = []
+        x = time_step(r[0], unit, -n, tzinfo)
+        while time_step(x, unit, n, tzinfo) > start:
+            head.append(x)
+            x = time_step(x, unit, -n, tzinfo)
+        r = head[::-1] + r
+    if end:
+        end = naive_utc(end)
+        x = time_step(r[-1], unit, n, tzinfo)
+        while x <= end:
+            r.append(x)
+            x = time_step(x, unit, n, tzinfo)
+    return r
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def mongo_json_default(o):
+    """
+    与json_util._json_convert的relaxed格式一致: ObjectId->$oid, datetime->$date, Decimal128->$numberDecimal
+    """
+    if isinstance(o, ObjectId):
+        return {'$oid': str(o)}
+    if isinstance(o, datetime.datetime):
+        if not o.tzinfo:
+            o = o.replace(tzinfo=datetime.timezone.utc)
+        if o >= EPOCH:
+            off = o.utcoffset()
+            tz = 'Z' if not off else o.strftime('%z')
+            ms = o.microsecond // 1000
+            return {'$date': '%s%s%s' % (o.strftime('%Y-%m-%dT%H:%M:%S'), '.%03d' % ms if ms else '', tz)}
+    from bson.decimal128 import Decimal128
+    if isinstance(o, Decimal128):
+        return {'$numberDecimal': str(o)}
+    r = json_util.default(o)
+    return json_util._json_convert(r) if isinstance(r, dict) else r
+
+
+def mongo_json_dumps(data):
+    """
+    直接把含bson类型的数据序列化成JSON bytes, 有orjson时用orjson
+    """
+    if orjson:
+        return orjson.dumps(data, default=mongo_json_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=mongo_json_default, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+def iter_mongo_json(head, results, key='results', chunk=100):
+    """
+    按chunk条一段逐段输出 {**head, key: results} 的JSON, 用于StreamingHttpResponse
+    """
+    s = mongo_json_dumps(head)
+    yield s[:-1] + (b',' if head else b'') + mongo_json_dumps(key) + b':['
+    for i in range(0, len(results), chunk):
+        yield (b',' if i else b'') + b','.join([mongo_json_dumps(d) for d in results[i:i + chunk]])
+    yield b']}'
+
+
+def run_partition(store, mapper, cond):
+    if isinstance(store, tuple):
+        cls, server, db, name = store
+        store = cls(server=server, db=db, name=name)
+    return mapper(store, cond)
+
+
+def find_partition(mapper, projection, store, cond):
+    return mapper(store.collection.find(cond, projection))
+
+
+def aggregate_partition(pipeline, store, cond):
+    ps = [{'$match': cond}] if cond else []
+    return list(store.collection.aggregate(ps + list(pipeline), allowDiskUse=True))
+
+
+def pipeline_filter(pipeline):
+    for a in pipeline:
+        if '$match' in a:
+            return a['$match']
+        if '$sample' not in a:
+            return None
+
+
+def result_docs(r):
+    if isinstance(r, int):
+        return r
+    if hasattr(r, 'matched_count'):
+        return r.matched_count + (1 if getattr(r, 'upserted_id', None) is not None else 0)
+
+
+class MetricsSink(object):
+    """
+    默认的指标收集: 按(collection, op)累计次数/耗时/文档数, 耗时按BUCKETS(毫秒)分桶
+    """
+    BUCKETS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def record(self, event):
+        key = (event['collection'], event['op'])
+        with self.lock:
+            c = self.counters.setdefault(key, dict(calls=0, ms=0, docs=0))
+            c['calls'] += 1
+            c['ms'] += event['ms']
+            c['docs'] += event['docs'] or 0
+            h = self.histograms.setdefault(key, [0] * (len(self.BUCKETS) + 1))
+            h[bisect.bisect_left(self.BUCKETS, event['ms'])] += 1
+
+
+class QueryInstrument(object):
+    """
+    Store操作计时: 每次find/count/group_by/update/upsert/aggregate生成一个事件交给sink.record(event),
+    耗时超过slow_ms的连同explain()结果记入slow_log. 不设置时Store不做任何计时.
+
+        Store.instrument = QueryInstrument(slow_ms=200)
+    """
+
+    def __init__(self, sink=None, slow_ms=None, explain=True, slow_log_size=100):
+        self.sink = sink or MetricsSink()
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.slow_log = collections.deque(maxlen=slow_log_size)
+
+    def observe(self, store, op, filter, start, docs=None, explain=None):
+        ms = (time.time() - start) * 1000
+        event = dict(op=op, collection=store.name, shape=filter_shape(filter), ms=ms, docs=docs)
+        self.sink.record(event)
+        if self.slow_ms is None or ms < self.slow_ms:
+            return
+        e = dict(event, filter=filter, time=datetime.datetime.now())
+        if self.explain and explain:
+            try:
+                e['explain'] = explain()
+            except Exception as ex:
+                e['explain_error'] = text_type(ex)
+        self.slow_log.append(e)
+        log.warning('slow mongo %s on %s: %.1fms %s', op, store.name, ms, json_util.dumps(filter))
+
+
+class InstrumentedCursor(object):
+    """
+    包装游标, 迭代完(或close)时把总耗时和返回文档数交给store.instrument;
+    调用方提前停止迭代时, 在游标被回收时补记
+    """
+
+    def __init__(self, cursor, store, op, filter, start, explain=None):
+        self.cursor = cursor
+        self.store = store
+        self.op = op
+        self.filter = filter
+        self.start = start
+        self.explain = explain
+        self.docs = 0
+        self.recorded = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            d = next(self.cursor)
+        except StopIteration:
+            self._record()
+            raise
+        self.docs += 1
         return d
 
-    def change_field_type(self, type_map, filter={}):
-        cond = self.normalize_filter(filter)
-        ps = [{'$set': {k:{f'${v}': f'${k}'}}} for k, v in type_map.items()]
-        return self.collection.update_many(cond, ps)
+    next = __next__
+
+    def __getitem__(self, k):
+        r = self.cursor[k]
+        return self if r is self.cursor else r
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def _record(self, explain=True):
+        if not self.recorded:
+            self.recorded = True
+            self.store.instrument.observe(self.store, self.op, self.filter, self.start, docs=self.docs,
+                                          explain=self.explain if explain else None)
+
+    def close(self):
+        self._record()
+        self.cursor.close()
+
+    def __del__(self):
+        if self.__dict__.get('recorded') is False:
+            try:
+                # no explain() round trip from a finalizer
+                self._record(explain=False)
+            except Exception:
+                pass
+
+
+def cache_get(cache, key):
+    hit = cache.get(key)
+    if hit and hit[0] > time.time():
+        return hit[1]
+
+
+def cache_set(cache, key, value, ttl, size=10000):
+    now = time.time()
+    if len(cache) >= size:
+        for k, v in list(cache.items()):
+            if v[0] <= now:
+                cache.pop(k, None)
+        if len(cache) >= size:
+            cache.clear()
+    cache[key] = (now + ttl, value)
+
+
+class EstimatedCount(int):
+    estimated = True
+
+    def __str__(self):
+        return '%d+' % self
+
+
+class FacetQuery(object):
+
+    def __init__(self, store, filter, projection=None, sort=None):
+        self.store = store
+        self.filter = filter
+        self.projection = projection
+        self.sort = sort
+        self._count = None
+        self._slice = None
+        self._results = None
+
+    def prefetch(self, skip, limit):
+        ps = []
+        if self.filter:
+            ps.append({'$match': self.filter})
+        page = []
+        if self.sort:
+            page.append({'$sort': dict(self.sort)})
+        page += [{'$skip': skip}, {'$limit': limit}]
+        if self.projection:
+            page.append({'$project': self.projection})
+        ps.append({'$facet': {'results': page, 'count': [{'$count': 'count'}]}})
+        r = next(iter(self.store.collection.aggregate(ps)), None) or {}
+        cs = r.get('count')
+        self._count = cs[0]['count'] if cs else 0
+        self._slice = (skip, skip + limit)
+        self._results = r.get('results', [])
+
+    def count(self):
+        if self._count is None:
+            self._count = self.store.count(self.filter)
+        return self._count
+
+    def __getitem__(self, k):
+        if isinstance(k, slice) and self._slice and k.start == self._slice[0] and (k.stop or 0) <= self._slice[1]:
+            return self._results[:k.stop - k.start]
+        if isinstance(k, slice):
+            start = k.start or 0
+            kwargs = dict(skip=start, sort=self.sort)
+            if k.stop is not None:
+                kwargs['limit'] = k.stop - start
+            return list(self.store.collection.find(self.filter, self.projection, **kwargs))
+        return self[k:k + 1][0]
+
+
+def normalize_projection(projection):
+    if isinstance(projection, (list, tuple, set)):
+        projection = dict([(a, 1) for a in projection])
+        if '_id' not in projection:
+            projection['_id'] = 0
+    return projection
+
+
+def plain_fields(cond):
+    return dict([(k, v) for k, v in cond.items()
+                 if not k.startswith('$') and '__' not in k
+                 and not (isinstance(v, dict) and any([str(a).startswith('$') for a in v]))])
+
+
+def set_on_insert_random(d, random_field=None, value={}):
+    """
+    upsert插入新文档时用$setOnInsert给random_field写入随机值, value里已有random_field时不写
+    """
+    if random_field and random_field not in value:
+        d['$setOnInsert'] = dict(d.get('$setOnInsert') or {})
+        d['$setOnInsert'][random_field] = random.random()
+    return d
+
+
+def upsert_document(value, random_field=None, **kwargs):
+    d = {'$set': value}
+    for k, v in kwargs.items():
+        d['$%s' % k] = v
+    return set_on_insert_random(d, random_field, value)
+
+
+def distinct_count_pipeline(filter, distinct):
+    gs = []
+    if filter:
+        gs.append({'$match': filter})
+    gs.append({'$group': {'_id': '$%s' % distinct}})
+    gs.append({'$group': {'_id': 0, 'count': {'$sum': 1}}})
+    return gs
+
+
+def upsert_operations(data_list, key='id', preset=lambda a, i: a, **kwargs):
+    from pymongo import UpdateOne
+    keys = key if isinstance(key, (list, tuple)) else [key]
+    for i, d in enumerate(data_list):
+        if isinstance(d, tuple):
+            d = d[-1]
+        d = preset(d, i) or d
+        yield UpdateOne(dict([(k, d[k]) for k in keys]), upsert_document(d, **kwargs), upsert=True)
+
+
+def key_filters(key, values, size=1000):
+    """
+    把key值元组列表按size条一组转成查询条件, 单个key用$in, 组合key用$or
+    """
+    keys = key if isinstance(key, (list, tuple)) else [key]
+    for vs in split_chunks(values, size):
+        if len(keys) == 1:
+            yield {keys[0]: {'$in': [v[0] for v in vs]}}
+        else:
+            yield {'$or': [dict(zip(keys, v)) for v in vs]}
+
+
+def bulk_write_result(r):
+    """
+    BulkWriteResult或BulkWriteError转成 {matched, upserted, modified, errors, upserted_ids}, upserted_ids为{op序号: _id}
+    """
+    if isinstance(r, Exception):
+        d = r.details
+        return dict(matched=d.get('nMatched', 0), upserted=d.get('nUpserted', 0), modified=d.get('nModified', 0),
+                    errors=d.get('writeErrors', []),
+                    upserted_ids=dict([(a['index'], a['_id']) for a in d.get('upserted', [])]))
+    return dict(matched=r.matched_count, upserted=r.upserted_count, modified=r.modified_count, errors=[],
+                upserted_ids=r.upserted_ids or {})
+
+
+def merge_bulk_result(result, i, ops, r):
+    result['count'] += len(ops)
+    for k in ['matched', 'upserted', 'modified']:
+        result[k] += r[k]
+    if r['errors']:
+        result['errors'].append(dict(chunk=i, errors=r['errors']))
+    return result
+
+
+def split_chunks(iterable, size=1000):
+    rs = []
+    for a in iterable:
+        rs.append(a)
+        if len(rs) >= size:
+            yield rs
+            rs = []
+    if rs:
+        yield rs
 
 
 def ensure_list(a):
@@ -297,61 +1997,120 @@ def ensure_list(a):
     return a
     
 
-def normalize_filter_condition(data, field_types={}, fields=None, search_fields=[]):
-    d = {}
-    if search_fields:
-        sv = data.get('search')
-        if sv:
-            v = {'$regex': sv}
-            for fn in search_fields:
-                d = {'$or': [d, {fn: v}]} if d else {fn: v}
-
-    mm = {
-        'exists': lambda v: {'$exists': v not in ['0', 'false', False]},
-        'isnull': lambda v: {'$ne' if v in ['0', 'false', ''] else '$eq': None},
-        'regex': lambda v: {'$regex': v},
-        'in': lambda v: {'$in': ensure_list(v)},
-        'nin': lambda v: {'$nin': ensure_list(v)},
-        'all': lambda v: {'$all': ensure_list(v)},
-        'gt': lambda v: {'$gt': v},
-        'lt': lambda v: {'$lt': v},
-        'ne': lambda v: {'$ne': v},
-        'eq': lambda v: {'$eq': v},
-        'size': lambda v: {'$size': v},
-        'gte': lambda v: {'$gte': v},
-        'lte': lambda v: {'$lte': v},
-        'type': lambda v: {'$type': v},
-    }
-    for a in data.keys():
-        if a == 'search':
+FILTER_OPERATORS = {
+    'exists': lambda v: {'$exists': v not in ['0', 'false', False]},
+    'isnull': lambda v: {'$ne' if v in ['0', 'false', ''] else '$eq': None},
+    'regex': lambda v: {'$regex': v},
+    'in': lambda v: {'$in': ensure_list(v)},
+    'nin': lambda v: {'$nin': ensure_list(v)},
+    'all': lambda v: {'$all': ensure_list(v)},
+    'gt': lambda v: {'$gt': v},
+    'lt': lambda v: {'$lt': v},
+    'ne': lambda v: {'$ne': v},
+    'eq': lambda v: {'$eq': v},
+    'size': lambda v: {'$size': v},
+    'gte': lambda v: {'$gte': v},
+    'lte': lambda v: {'$lte': v},
+    'type': lambda v: {'$type': v},
+}
+
+FILTER_PLAN_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=FILTER_PLAN_CACHE_SIZE)
+def compile_filter_keys(keys):
+    """
+    把查询参数名解析成计划: [(参数名, 字段路径, 顶层字段, 操作函数, 是否取反)], 按参数名元组缓存
+    """
+    plan = []
+    for k in keys:
+        if k == 'search':
             continue
-        v = data[a]
+        a = k
+        mf = None
+        is_not = False
         ps = a.split('__')
-        if len(ps)>1:
+        if len(ps) > 1:
             mn = ps[-1]
-            mf = mm.get(mn)
+            mf = FILTER_OPERATORS.get(mn)
             if mf:
-                sl = len(mn)+2
-                a = a[:-sl]
+                a = a[:-(len(mn) + 2)]
                 a = a.replace('__', '.')
                 is_not = a.endswith('.not')
                 if is_not:
-                    a=a[:-4]
-                if isinstance(v, str):
-                    format_func = field_types.get(a)
-                    if format_func:
-                        v = format_func(v)
-                v = mf(v)
-                if is_not:
-                    v = {'$not': v}
+                    a = a[:-4]
+        ps = re.split(r'__|\.', a)
+        plan.append((k, ".".join(ps), ps[0], mf, is_not))
+    return tuple(plan)
 
 
-        if fields:
-            ps = re.split(r'__|\.', a) ##a.split('__')
-            if ps[0] not in fields:
-                continue
-            a = ".".join(ps)
-        a = a.replace('__', '.')
+SEARCH_TOKENS_FIELD = '_search_tokens'
+
+
+def search_backend_from_indexes(indexes):
+    r = 'regex'
+    for a in indexes.values():
+        ks = [k for k, d in a['key']]
+        if any([d == 'text' for k, d in a['key']]):
+            return 'text'
+        if ks[0] == SEARCH_TOKENS_FIELD:
+            r = 'ngram'
+    return r
+
+
+def search_token_operations(docs, search_fields):
+    from pymongo import UpdateOne
+    return [UpdateOne({'_id': d['_id']},
+                      {'$set': {SEARCH_TOKENS_FIELD: search_tokens([access(d, f) for f in search_fields])}})
+            for d in docs]
+
+
+RE_CJK = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+RE_WORD = re.compile(r'[^\W\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+
+def search_tokens(values, query=False):
+    """
+    ngram分词: 中文连续字符取单字和相邻二字, 其它按单词小写.
+    query=True时给查询用, 中文只取二字(单个字时取单字)
+    """
+    ts = []
+    for v in values:
+        if not isinstance(v, text_type):
+            continue
+        for run in RE_CJK.findall(v):
+            if not query or len(run) == 1:
+                ts += list(run)
+            ts += [run[i:i + 2] for i in range(len(run) - 1)]
+        ts += [w.lower() for w in RE_WORD.findall(v)]
+    return list(dict.fromkeys(ts))
+
+
+def normalize_filter_condition(data, field_types={}, fields=None, search_fields=[], search_backend=None):
+    d = {}
+    if search_fields:
+        sv = data.get('search')
+        if sv and search_backend == 'text':
+            d = {'$text': {'$search': sv}}
+        elif sv and search_backend == 'ngram' and search_tokens([sv], query=True):
+            d = {SEARCH_TOKENS_FIELD: {'$all': search_tokens([sv], query=True)}}
+        elif sv:
+            v = {'$regex': sv}
+            for fn in search_fields:
+                d = {'$or': [d, {fn: v}]} if d else {fn: v}
+
+    for k, a, root, mf, is_not in compile_filter_keys(tuple(data.keys())):
+        if fields and root not in fields:
+            continue
+        v = data[k]
+        if mf:
+            if isinstance(v, str):
+                format_func = field_types.get(a)
+                if format_func:
+                    v = format_func(v)
+            v = mf(v)
+            if is_not:
+                v = {'$not': v}
         format_func = field_types.get(a)
         expr = format_func(v) if not isinstance(v, dict) and format_func else v
         if a in d and isinstance(d[a], dict):
@@ -359,7 +2118,6 @@ def normalize_filter_condition(data, field_types={}, fields=None, search_fields=
         else:
             d[a] = expr
 
-
     return d
 
 def json_schema(d, prefix=''):
@@ -386,6 +2144,85 @@ def json_schema(d, prefix=''):
     return r
 
 
+BSON_TYPE_MAP = {
+    'int': 'integer',
+    'long': 'integer',
+    'double': 'number',
+    'decimal': 'number',
+    'bool': 'boolean',
+    'date': 'datetime',
+    'objectId': 'oid',
+    'string': 'string',
+    'array': 'array',
+    'object': 'object',
+    'null': 'null',
+}
+
+
+def profile_schema(collection, filter=None, size=1000, depth=3):
+    """
+    用$objectToArray/$type在服务端统计字段类型, 嵌套对象展开depth层, 字段名用.连接.
+    返回 {字段: {'types': {类型: 次数}, 'count': 出现次数, 'null_rate': 空值或缺失比例}}
+    """
+    ps = profile_schema_pipeline(filter, size=size, depth=depth)
+    return profile_schema_result(next(iter(collection.aggregate(ps, allowDiskUse=True)), None))
+
+
+def profile_schema_pipeline(filter=None, size=1000, depth=3):
+    ps = []
+    if filter:
+        ps.append({'$match': filter})
+    if size:
+        ps.append({'$sample': {'size': size}})
+    ps.append({'$project': {'_id': 0, 'items': {'$objectToArray': '$$ROOT'}}})
+    ps.append({'$project': {'items': 1, 'frontier': '$items'}})
+    for i in range(depth - 1):
+        children = {'$reduce': {
+            'input': '$frontier',
+            'initialValue': [],
+            'in': {'$concatArrays': ['$$value', {'$cond': [
+                {'$eq': [{'$type': '$$this.v'}, 'object']},
+                {'$map': {'input': {'$objectToArray': '$$this.v'}, 'as': 'c',
+                          'in': {'k': {'$concat': ['$$this.k', '.', '$$c.k']}, 'v': '$$c.v'}}},
+                []
+            ]}]}
+        }}
+        ps.append({'$project': {'items': 1, 'frontier': children}})
+        ps.append({'$project': {'items': {'$concatArrays': ['$items', '$frontier']}, 'frontier': 1}})
+    ps.append({'$facet': {
+        'fields': [
+            {'$unwind': '$items'},
+            {'$group': {'_id': {'k': '$items.k', 't': {'$type': '$items.v'}}, 'count': {'$sum': 1}}}
+        ],
+        'total': [{'$count': 'count'}]
+    }})
+    return ps
+
+
+def profile_schema_result(r):
+    r = r or {}
+    total = r.get('total') and r['total'][0]['count'] or 0
+    rs = {}
+    for a in r.get('fields', []):
+        fn = a['_id']['k']
+        t = BSON_TYPE_MAP.get(a['_id']['t'], a['_id']['t'])
+        d = rs.setdefault(fn, {'types': {}, 'count': 0})
+        d['types'][t] = d['types'].get(t, 0) + a['count']
+        d['count'] += a['count']
+    for fn, d in rs.items():
+        nulls = d['types'].get('null', 0) + total - d['count']
+        d['null_rate'] = nulls / total if total else 0
+    return rs
+
+
+def schema_from_profile(profile):
+    rs = {}
+    for fn, d in profile.items():
+        ts = [(c, t) for t, c in d['types'].items() if t != 'null']
+        rs[fn] = max(ts)[1] if ts else 'null'
+    return rs
+
+
 def filed_type_func(f):
     return {
         'integer': int,
@@ -408,38 +2245,487 @@ def drop_id_field(c):
 class Schema(Store):
     name = 'XYZ_STORE_SCHEMA'
 
-    def guess(self, name, *args, **kwargs):
-        st = Store(name=name)
-        rs = {}
-        for d in st.random_find(*args, **kwargs):
-            rs.update(json_schema(d))
+    def guess(self, name, cond={}, count=None, depth=3):
+        rs = schema_from_profile(Store(name=name).profile(cond, size=count, depth=depth, refresh=True))
         self.upsert({'name': name}, {'guess': rs})
+        SCHEMA_CACHE.pop(('desc', self.db.name, name), None)
         return rs
 
     def desc(self, name, *args, **kwargs):
+        key = ('desc', self.db.name, name)
+        d = cache_get(SCHEMA_CACHE, key)
+        if d is not None:
+            return d
         d = self.collection.find_one({'name': name}, {'_id': 0})
         if not d or not d.get('guess'):
             self.guess(name, *args, **kwargs)
             d = self.collection.find_one({'name': name}, {'_id': 0})
+        if self.schema_cache_ttl:
+            cache_set(SCHEMA_CACHE, key, d, self.schema_cache_ttl, SCHEMA_CACHE_SIZE)
         return d
 
 
+ROLLUP_META = 'XYZ_STORE_ROLLUP'
+MIGRATION_META = 'XYZ_STORE_MIGRATION'
+SKETCH_META = 'XYZ_STORE_SKETCH'
+ROLLUP_OPERATORS = ['$sum', '$min', '$max']
+
+
+class Rollup(object):
+    """
+    预聚合: 把source集合按dimensions分组, 用$merge写入name集合, 每次refresh只处理watermark大于上次记录值的文档.
+    watermark需是插入时单调递增且之后不再改变的字段(如_id, 创建时间). measures只支持$sum/$min/$max.
+
+        daily = Rollup('orders', 'orders_daily', {'day': date_format('created'), 'shop': '$shop'},
+                       {'count': {'$sum': 1}, 'amount': {'$sum': '$amount'}})
+        class Orders(Store):
+            rollups = [daily]
+
+    之后 Orders().count_by(date_format('created'), filter={'shop': 'x'}) 直接从orders_daily汇总.
+    同一个watermark区间合并两次会重复累加, 所以refresh在ROLLUP_META上先占一个lease秒的租约,
+    并发的refresh拿不到租约时直接返回不合并; 合并中途失败时用rebuild重建.
+    """
+
+    def __init__(self, source, name, dimensions, measures={'count': {'$sum': 1}}, watermark='_id', filter=None,
+                 lease=600):
+        self.source = source
+        self.name = name
+        if isinstance(dimensions, (list, tuple)):
+            dimensions = group_expression(dimensions)
+        self.dimensions = dimensions
+        self.measures = group_aggregate(measures)
+        for n, spec in self.measures.items():
+            if list(spec)[0] not in ROLLUP_OPERATORS:
+                raise ValueError('rollup measure %s: only %s are supported' % (n, ROLLUP_OPERATORS))
+        self.watermark = watermark
+        self.filter = filter or {}
+        self.lease = lease
+
+    def get_store(self, name=None):
+        return Store(name=name or self.name)
+
+    def get_watermark(self):
+        m = self.get_store(ROLLUP_META).collection.find_one({'name': self.name}) or {}
+        return m.get('watermark')
+
+    def acquire(self):
+        """
+        占用refresh租约, 成功时返回租约前的元数据, 其它refresh正在进行时返回None
+        """
+        from pymongo.errors import DuplicateKeyError
+        meta = self.get_store(ROLLUP_META).collection
+        meta.create_index([('name', 1)], unique=True)
+        try:
+            meta.update_one({'name': self.name}, {'$setOnInsert': {'name': self.name}}, upsert=True)
+        except DuplicateKeyError:
+            pass
+        now = datetime.datetime.now()
+        free = [{'refreshing_until': None}, {'refreshing_until': {'$lt': now}}]
+        return meta.find_one_and_update({'name': self.name, '$or': free},
+                                        {'$set': {'refreshing_until': now + datetime.timedelta(seconds=self.lease)}})
+
+    def release(self, **kwargs):
+        kwargs['refreshing_until'] = None
+        self.get_store(ROLLUP_META).collection.update_one({'name': self.name}, {'$set': kwargs})
+
+    def refresh(self):
+        m = self.acquire()
+        if m is None:
+            return self.get_watermark()
+        try:
+            upper = self._refresh(m.get('watermark'))
+        except Exception:
+            self.release()
+            raise
+        if upper == m.get('watermark'):
+            self.release()
+        else:
+            self.release(watermark=upper, refreshed_at=datetime.datetime.now())
+        return upper
+
+    def _refresh(self, wm):
+        src = self.get_store(self.source)
+        last = src.collection.find_one(self.filter, {self.watermark: 1}, sort=[(self.watermark, -1)])
+        if not last:
+            return wm
+        upper = access(last, self.watermark)
+        if wm is not None and upper <= wm:
+            return wm
+        cond = {'$lte': upper}
+        if wm is not None:
+            cond['$gt'] = wm
+        match = {self.watermark: cond}
+        if self.filter:
+            match = {'$and': [self.filter, match]}
+        d = {'_id': self.dimensions}
+        d.update(self.measures)
+        merges = dict([(n, {list(spec)[0].replace('$sum', '$add'): [f'${n}', f'$$new.{n}']})
+                       for n, spec in self.measures.items()])
+        ps = [
+            {'$match': match},
+            {'$group': d},
+            {'$merge': {'into': self.name, 'on': '_id', 'whenMatched': [{'$set': merges}],
+                        'whenNotMatched': 'insert'}}
+        ]
+        list(src.collection.aggregate(ps, allowDiskUse=True))
+        return upper
+
+    def rebuild(self):
+        self.get_store().collection.drop()
+        self.get_store(ROLLUP_META).collection.delete_one({'name': self.name})
+        return self.refresh()
+
+    def dimension_of(self, exp):
+        for n, e in self.dimensions.items():
+            if e == exp:
+                return n
+
+    def covers(self, field, aggregate, filter=None):
+        exp = group_expression(field)
+        if isinstance(field, (list, tuple)):
+            if not all([self.dimension_of(e) for e in exp.values()]):
+                return False
+        elif not self.dimension_of(exp):
+            return False
+        for n, spec in group_aggregate(aggregate).items():
+            if self.measures.get(n) != spec:
+                return False
+        filter = filter or {}
+        for k, v in self.filter.items():
+            if filter.get(k) != v:
+                return False
+        for k in filter:
+            if k in self.filter:
+                continue
+            if k.startswith('$') or not self.dimension_of('$%s' % k):
+                return False
+        return True
+
+    def group_by(self, field, aggregate, filter=None):
+        exp = group_expression(field)
+        if isinstance(field, (list, tuple)):
+            exp = dict([(k, '$_id.%s' % self.dimension_of(e)) for k, e in exp.items()])
+        else:
+            exp = '$_id.%s' % self.dimension_of(exp)
+        ps = []
+        filter = dict([(k, v) for k, v in (filter or {}).items() if k not in self.filter])
+        if filter:
+            ps.append({'$match': dict([('_id.%s' % self.dimension_of('$%s' % k), v) for k, v in filter.items()])})
+        d = {'_id': exp}
+        for n, spec in group_aggregate(aggregate).items():
+            d[n] = {list(spec)[0]: f'${n}'}
+        ps.append({'$group': d})
+        return self.get_store().collection.aggregate(ps)
+
+
+async def maybe_await(a):
+    import inspect
+    if inspect.isawaitable(a):
+        a = await a
+    return a
+
+
+class AsyncStore(StoreBase):
+    """
+    Store的asyncio版本, 基于pymongo AsyncMongoClient或motor, 与Store共用StoreBase里的过滤条件规范化和字段类型转换.
+    database可以传入任意兼容的异步数据库对象(如测试用的内存实现).
+    find/random_find/group_by返回异步迭代器, 其余方法需要await; Store上其他的同步方法这里没有.
+    """
+
+    def __init__(self, server=SERVER, db=DB, name=None, database=None):
+        if database is None:
+            database = getattr(get_async_mongo_client(server, self.timeout, **self.client_options), db)
+        self.db = database
+        self.collection = self.db[name or self.name]
+        if name:
+            self.name = name
+
+    @cached_property
+    def _fields(self):
+        return dict(self.fields) if isinstance(self.fields, dict) else {}
+
+    async def load_schema(self, size=None, depth=3, refresh=False):
+        """
+        异步加载schema, 之后normalize_filter(cast=True)才会按字段类型转换
+        """
+        size = self.schema_sample_size if size is None else size
+        key = ('profile', self.db.name, self.name, json_util.dumps(None), size, depth)
+        r = None if refresh else cache_get(SCHEMA_CACHE, key)
+        if r is None:
+            ps = profile_schema_pipeline(size=size, depth=depth)
+            rs = [a async for a in self._aggregate(ps, allowDiskUse=True)]
+            r = profile_schema_result(rs[0] if rs else None)
+            if self.schema_cache_ttl:
+                cache_set(SCHEMA_CACHE, key, r, self.schema_cache_ttl, SCHEMA_CACHE_SIZE)
+        fs = schema_from_profile(r)
+        if self.fields and isinstance(self.fields, dict):
+            fs.update(self.fields)
+        self.__dict__['_fields'] = fs
+        self.__dict__.pop('_field_type_map', None)
+        return fs
+
+    async def load_search_backend(self):
+        """
+        异步读索引确定search_backend, 与Store.get_search_backend共用缓存; search和ngram分词前会自动调用
+        """
+        if self.search_backend:
+            return self.search_backend
+        key = ('search_backend', self.db.name, self.name)
+        r = cache_get(SCHEMA_CACHE, key)
+        if r is None:
+            r = search_backend_from_indexes(await maybe_await(self.collection.index_information()))
+            cache_set(SCHEMA_CACHE, key, r, self.schema_cache_ttl or SCHEMA_CACHE_TTL, SCHEMA_CACHE_SIZE)
+        self.__dict__['_search_backend'] = r
+        return r
+
+    def get_search_backend(self):
+        if self.search_backend:
+            return self.search_backend
+        if '_search_backend' not in self.__dict__:
+            raise RuntimeError('AsyncStore.load_search_backend() must be awaited before searching')
+        return self.__dict__['_search_backend']
+
+    async def _prepare(self):
+        if self.search_fields and not self.search_backend and '_search_backend' not in self.__dict__:
+            await self.load_search_backend()
+
+    async def _aggregate(self, pipeline, **kwargs):
+        async for a in await maybe_await(self.collection.aggregate(pipeline, **kwargs)):
+            yield a
+
+    async def get(self, cond):
+        if isinstance(cond, text_type):
+            cond = {'_id': ObjectId(cond)}
+        else:
+            await self._prepare()
+            cond = self.normalize_filter(cond)
+        return await self.collection.find_one(cond)
+
+    async def get_or_create(self, cond, defaults={}):
+        if isinstance(cond, text_type):
+            return await self.get(cond)
+        from pymongo import ReturnDocument
+        await self._prepare()
+        d = plain_fields(cond)
+        d.update(defaults)
+        if self.random_field:
+            d.setdefault(self.random_field, random.random())
+        d, refresh = self.add_search_tokens(d)
+        r = await self.collection.find_one_and_update(self.normalize_filter(cond), {'$setOnInsert': d},
+                                                      upsert=True, return_document=ReturnDocument.AFTER)
+        if refresh and SEARCH_TOKENS_FIELD not in r:
+            await self.refresh_search_tokens({'_id': r['_id']})
+        return r
+
+    async def find(self, filter=None, projection=None, **kwargs):
+        await self._prepare()
+        filter = self.normalize_filter(filter)
+        if 'sort' not in kwargs:
+            ordering = kwargs.pop('ordering', self.ordering)
+            kwargs['sort'] = [ordering_to_sort(s) for s in ordering]
+        self._record_query(filter, kwargs['sort'])
+        async for a in self.collection.find(filter, normalize_projection(projection), **kwargs):
+            yield a
+
+    def search(self, cond, *args, **kwargs):
+        return self.find(cond, *args, **kwargs)
+
+    async def random_find(self, cond={}, count=10, fields=None):
+        await self._prepare()
+        async for a in self._aggregate(self._random_find_pipeline(cond, count, fields)):
+            yield a
+
+    async def random_get(self, *args, **kwargs):
+        async for a in self.random_find(args[0], count=1, **kwargs):
+            return a
+
+    async def group_by(self, field, aggregate={'count': {'$sum': 1}}, filter=None, unwind=False, prepare=[]):
+        await self._prepare()
+        async for a in self._aggregate(self._group_by_pipeline(field, aggregate, filter, unwind, prepare)):
+            yield a
+
+    async def count_by(self, field, output='dict', **kwargs):
+        rs = [a async for a in self.group_by(field, **kwargs)]
+        if output == 'dict':
+            rs = dict([(a['_id'], a['count']) for a in rs])
+        return rs
+
+    async def sum(self, field, filter=None):
+        await self._prepare()
+        filter = self.normalize_filter(filter)
+        self._record_query(filter)
+        gs = [{'$match': filter}] if filter else []
+        gs.append({'$group': {'_id': 0, 'result': {'$sum': '$%s' % field}}})
+        async for a in self._aggregate(gs):
+            return a['result']
+
+    async def count(self, filter=None, distinct=False):
+        await self._prepare()
+        filter = self.normalize_filter(filter)
+        self._record_query(filter)
+        if distinct:
+            async for a in self._aggregate(distinct_count_pipeline(filter, distinct)):
+                return a['count']
+            return 0
+        if not filter:
+            return await self.collection.estimated_document_count()
+        return await self.collection.count_documents(filter)
+
+    async def upsert(self, cond, value, **kwargs):
+        await self._prepare()
+        value, refresh = self.add_search_tokens(value)
+        r = await self.collection.update_one(cond, upsert_document(value, random_field=self.random_field, **kwargs),
+                                             upsert=True)
+        if refresh:
+            await self.refresh_search_tokens(cond)
+        return r
+
+    async def update(self, cond, value, **kwargs):
+        await self._prepare()
+        cond = self.normalize_filter(cond)
+        refresh = False
+        d = {}
+        if value:
+            value, refresh = self.add_search_tokens(value)
+            d['$set'] = value
+        for k, v in kwargs.items():
+            d['$%s' % k] = v
+        self._record_query(cond)
+        ids = [(a['_id'],) async for a in self.collection.find(cond, {'_id': 1})] if refresh else []
+        r = await self.collection.update_many(cond, d)
+        for f in key_filters('_id', ids):
+            await self.refresh_search_tokens(f)
+        return r
+
+    async def inc(self, cond, value):
+        await self._prepare()
+        cond = self.normalize_filter(cond)
+        return await self.collection.update_many(cond, set_on_insert_random({'$inc': value}, self.random_field, value),
+                                                upsert=True)
+
+    async def add_to_set(self, cond, value):
+        await self._prepare()
+        cond = self.normalize_filter(cond)
+        return await self.collection.update_many(cond, set_on_insert_random({'$addToSet': value}, self.random_field, value),
+                                                upsert=True)
+
+    async def refresh_search_tokens(self, filter=None, batch_size=1000):
+        n = 0
+        ds = []
+        ps = dict([(f, 1) for f in self.search_fields])
+        async for d in self.collection.find(filter or {}, ps, batch_size=batch_size):
+            ds.append(d)
+            if len(ds) >= batch_size:
+                await self.collection.bulk_write(search_token_operations(ds, self.search_fields), ordered=False)
+                n += len(ds)
+                ds = []
+        if ds:
+            await self.collection.bulk_write(search_token_operations(ds, self.search_fields), ordered=False)
+            n += len(ds)
+        return n
+
+    async def bulk_write(self, ops, ordered=False):
+        from pymongo.errors import BulkWriteError
+        try:
+            return bulk_write_result(await self.collection.bulk_write(ops, ordered=ordered))
+        except BulkWriteError as e:
+            return bulk_write_result(e)
+
+    async def batch_upsert(self, data_list, key='id', preset=lambda a, i: a, chunk=1000, workers=0, **kwargs):
+        """
+        同Store.batch_upsert, workers>0时最多workers组bulk_write并发执行
+        """
+        import asyncio
+        await self._prepare()
+        result = dict(count=0, matched=0, upserted=0, modified=0, errors=[])
+        refresh = []
+        preset = self._search_token_preset(preset, key, refresh)
+        chunks = enumerate(split_chunks(upsert_operations(data_list, key, preset, random_field=self.random_field,
+                                                          **kwargs), chunk))
+        if not workers:
+            for i, ops in chunks:
+                merge_bulk_result(result, i, ops, await self.bulk_write(ops))
+        else:
+            sem = asyncio.Semaphore(workers)
+
+            async def one_chunk(i, ops):
+                try:
+                    merge_bulk_result(result, i, ops, await self.bulk_write(ops))
+                finally:
+                    sem.release()
+
+            tasks = []
+            for i, ops in chunks:
+                await sem.acquire()
+                tasks.append(asyncio.ensure_future(one_chunk(i, ops)))
+            await asyncio.gather(*tasks)
+        for f in key_filters(key, refresh, chunk):
+            await self.refresh_search_tokens(f)
+        return result
+
+
 if USING_DJANGO:
     from django.utils.functional import cached_property
-    from django.core.paginator import Paginator
+    from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
     from django.dispatch import Signal
 
     from rest_framework.pagination import PageNumberPagination
     from rest_framework import permissions, exceptions
-    from rest_framework import viewsets, response, serializers, fields
+    from rest_framework import viewsets, response, serializers, fields, renderers, decorators
+    from django.http import StreamingHttpResponse
+
+    class MongoPage(Page):
+        more = None
+
+        def has_next(self):
+            if self.more is not None:
+                return self.more
+            return super(MongoPage, self).has_next()
+
 
     class MongoPaginator(Paginator):
+        """
+        count是EstimatedCount(达到count_limit封顶)时不知道总页数, 不按count截断和校验页码,
+        而是多取一条判断是否还有下一页
+        """
 
         @cached_property
         def count(self):
             # print('count')
             return self.object_list.count()
 
+        @property
+        def estimated(self):
+            return getattr(self.count, 'estimated', False)
+
+        def validate_number(self, number):
+            if not self.estimated:
+                return super(MongoPaginator, self).validate_number(number)
+            try:
+                if isinstance(number, float) and not number.is_integer():
+                    raise ValueError
+                number = int(number)
+            except (TypeError, ValueError):
+                raise PageNotAnInteger('That page number is not an integer')
+            if number < 1:
+                raise EmptyPage('That page number is less than 1')
+            return number
+
+        def page(self, number):
+            if not self.estimated:
+                return super(MongoPaginator, self).page(number)
+            number = self.validate_number(number)
+            bottom = (number - 1) * self.per_page
+            rs = list(self.object_list[bottom:bottom + self.per_page + 1])
+            if not rs and number > 1:
+                raise EmptyPage('That page contains no results')
+            page = self._get_page(rs[:self.per_page], number, self)
+            page.more = len(rs) > self.per_page
+            return page
+
+        def _get_page(self, *args, **kwargs):
+            return MongoPage(*args, **kwargs)
+
 
     class MongoPageNumberPagination(PageNumberPagination):
         django_paginator_class = MongoPaginator
@@ -447,14 +2733,79 @@ if USING_DJANGO:
         page_size_query_param = 'page_size'
         max_page_size = 1000
 
+        def paginate_queryset(self, queryset, request, view=None):
+            if hasattr(queryset, 'prefetch'):
+                page_size = self.get_page_size(request)
+                try:
+                    number = int(request.query_params.get(self.page_query_param) or 1)
+                except ValueError:
+                    number = 0
+                if page_size and number > 0:
+                    queryset.prefetch((number - 1) * page_size, page_size)
+            return super(MongoPageNumberPagination, self).paginate_queryset(queryset, request, view=view)
 
+        def get_paginated_response(self, data):
+            r = super(MongoPageNumberPagination, self).get_paginated_response(data)
+            count = self.page.paginator.count
+            if getattr(count, 'estimated', False):
+                r.data['count'] = str(count)
+            return r
 
 
-    def get_paginated_response(view, query, wrap=lambda a: a):
+
+
+    def get_paginated_response(view, query, wrap=lambda a: a, batch_wrap=None):
         pager = MongoPageNumberPagination()
         ds = pager.paginate_queryset(query, view.request, view=view)
         rs = [wrap(a) for a in ds]
-        return pager.get_paginated_response(json_util._json_convert(rs))
+        if batch_wrap:
+            rs = batch_wrap(rs)
+        if getattr(view, 'fast_json', False) and len(rs) > view.stream_threshold:
+            d = pager.get_paginated_response([]).data
+            d.pop('results')
+            return StreamingHttpResponse(iter_mongo_json(d, rs), content_type='application/json')
+        to_json = getattr(view, 'to_json', json_util._json_convert)
+        return pager.get_paginated_response(to_json(rs))
+
+
+    class MongoCursorPagination(object):
+        page_size = 100
+        page_size_query_param = 'page_size'
+        max_page_size = 1000
+        cursor_query_param = 'cursor'
+        count_query_param = '_count'
+
+        def get_page_size(self, request):
+            try:
+                ps = int(request.query_params[self.page_size_query_param])
+                if ps > 0:
+                    return min(ps, self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+            return self.page_size
+
+        def paginate(self, store, cond, request, projection=None, sort=None):
+            from rest_framework.utils.urls import replace_query_param
+            qps = request.query_params
+            try:
+                rs, next = store.keyset_find(cond, projection, sort=sort, after=qps.get(self.cursor_query_param),
+                                             limit=self.get_page_size(request))
+            except (ValueError, TypeError, IndexError):
+                raise exceptions.ValidationError({self.cursor_query_param: 'invalid cursor'})
+            if next:
+                next = replace_query_param(request.build_absolute_uri(), self.cursor_query_param, next)
+            d = dict(next=next, results=rs)
+            if qps.get(self.count_query_param) in ['1', 'true']:
+                d['count'] = store.count(cond)
+            return d
+
+
+    def get_cursor_paginated_response(view, cond, projection=None, sort=None, batch_wrap=None):
+        d = MongoCursorPagination().paginate(view.store, cond, view.request, projection=projection, sort=sort)
+        if batch_wrap:
+            d['results'] = batch_wrap(d['results'])
+        d['results'] = getattr(view, 'to_json', json_util._json_convert)(d['results'])
+        return response.Response(d)
 
 
     def model_get_and_patch(view, default={}, field_names=None):
@@ -509,12 +2860,28 @@ if USING_DJANGO:
             return rs
 
 
+    class MongoJSONRenderer(renderers.JSONRenderer):
+
+        def render(self, data, accepted_media_type=None, renderer_context=None):
+            if data is None:
+                return b''
+            return mongo_json_dumps(data)
+
+
     mongo_posted = Signal()
+    mongo_batch_posted = Signal()
 
     class MongoViewSet(viewsets.ViewSet):
         permission_classes = [permissions.IsAdminUser]
         store_name = None
         store_class = None
+        pagination_mode = 'page'
+        count_mode = 'exact'
+        fast_json = False
+        stream_threshold = 500
+        control_params = ['page', 'page_size', 'cursor', '_count', 'fields', 'exclude', 'ordering', '_random']
+        fields_query_param = 'fields'
+        exclude_query_param = 'exclude'
 
         def dispatch(self, request, *args, **kwargs):
             self.store = self.get_store()
@@ -529,6 +2896,17 @@ if USING_DJANGO:
                 return Store(name=self.store_name)
             raise exceptions.NotFound()
 
+        def get_renderers(self):
+            if self.fast_json:
+                return [MongoJSONRenderer()]
+            return super(MongoViewSet, self).get_renderers()
+
+        def to_json(self, data):
+            """
+            fast_json时原样返回, 由MongoJSONRenderer一次性序列化bson类型, 否则先转换成json_util格式
+            """
+            return data if self.fast_json else json_util._json_convert(data)
+
         def get_foreign_key(self, store_name, id):
             st = self.get_store(store_name)
             return st.collection.get(id=id)
@@ -548,7 +2926,7 @@ if USING_DJANGO:
         def list(self, request):
             # print(request.query_params)
             qps = request.query_params
-            cond = self.store.normalize_filter(qps)
+            cond = self.store.normalize_filter(dict([(k, qps[k]) for k in qps if k not in self.control_params]))
             # print(cond)
             cond = self.filter_query(cond)
             randc = qps.get('_random')
@@ -556,21 +2934,78 @@ if USING_DJANGO:
             kwargs = {}
             if ordering:
                 kwargs['sort'] = [ordering_to_sort(ordering)]
+            projection = self.get_projection()
             if randc:
-                rs = self.store.random_find(cond, count=int(randc), fields=self.get_serialize_fields())
-                return response.Response(dict(results=json_util._json_convert(rs)))
-            rs = self.store.find(cond, self.get_serialize_fields(), **kwargs)
-            return get_paginated_response(self, rs, wrap=self.eval_foreign_keys)
+                rs = self.store.random_find(cond, count=int(randc), fields=normalize_projection(projection))
+                return response.Response(dict(results=self.to_json(list(rs))))
+            if self.pagination_mode == 'cursor' or 'cursor' in qps:
+                return get_cursor_paginated_response(self, cond, projection, sort=kwargs.get('sort'),
+                                                     batch_wrap=self.eval_foreign_keys_batch)
+            if self.count_mode == 'facet':
+                rs = self.store.facet_find(cond, projection, **kwargs)
+            else:
+                rs = self.store.find(cond, projection, **kwargs)
+            return get_paginated_response(self, rs, batch_wrap=self.eval_foreign_keys_batch)
 
         def eval_foreign_keys(self, d):
             fks = getattr(self, 'foreign_keys', None)
             return self.store.eval_foreign_keys(d, foreign_keys=fks)
 
+        def eval_foreign_keys_batch(self, ds):
+            fks = getattr(self, 'foreign_keys', None)
+            return self.store.eval_foreign_keys_batch(ds, foreign_keys=fks,
+                                                      projections=getattr(self, 'foreign_projections', None))
+
+        def get_projection(self):
+            """
+            由fields/exclude参数(逗号分隔)生成projection, 字段须在store的schema里;
+            外键的子字段(如 user.name)只用来限定外键文档取回或排除的字段
+            """
+            qps = self.request.query_params
+            split = lambda a: [f.strip() for f in (qps.get(a) or '').split(',') if f.strip()]
+            fs = split(self.fields_query_param)
+            es = split(self.exclude_query_param)
+            base = self.get_serialize_fields()
+            self.foreign_projections = fps = {}
+            if not fs and not es:
+                return base
+            known = self.store._fields
+            fks = getattr(self, 'foreign_keys', None) or {}
+            invalid = [f for f in fs + es if known and f.split('.')[0] not in known and f not in known]
+            if invalid:
+                raise exceptions.ValidationError({self.fields_query_param: 'unknown fields: %s' % ','.join(invalid)})
+            for f in [f for f in es if '.' in f and f.split('.')[0] in fks]:
+                r, _, sub = f.partition('.')
+                fps.setdefault(r, {})[sub] = 0
+                es.remove(f)
+            if not fs:
+                if not es:
+                    return base
+                if base:
+                    return [f for f in (base.keys() if isinstance(base, dict) else base) if f not in es]
+                return dict([(f, 0) for f in es])
+            if base:
+                bs = base.keys() if isinstance(base, dict) else base
+                fs = [f for f in fs if f.split('.')[0] in bs]
+            projection = {}
+            for f in fs:
+                r, _, sub = f.partition('.')
+                if r in fks:
+                    projection[r] = 1
+                    if sub:
+                        # mongo不能混用包含和排除, 指定了外键的fields时忽略它的exclude
+                        if 0 in fps.get(r, {}).values():
+                            fps[r] = {}
+                        fps.setdefault(r, {})[sub] = 1
+                else:
+                    projection[f] = 1
+            return projection
+
 
         def get_object(self, id=None):
             _id = id if id else self.kwargs['pk']
             cond = {'_id': ObjectId(_id)}
-            return json_util._json_convert(self.eval_foreign_keys(self.store.collection.find_one(cond, None)))
+            return self.to_json(self.eval_foreign_keys(self.store.collection.find_one(cond, None)))
 
         def retrieve(self, request, pk):
             return response.Response(self.get_object())
@@ -587,16 +3022,75 @@ if USING_DJANGO:
             self.store.update({'_id': ObjectId(pk)}, data)
             new_instance = self.get_object()
             mongo_posted.send_robust(sender=type(self), instance=new_instance, update=data, created=False)
-            return response.Response(json_util._json_convert(new_instance))
+            return response.Response(new_instance)
 
         def create(self, request, *args, **kargs):
-            data = self.get_serialized_data()
+            data, refresh = self.store.add_search_tokens(self.get_serialized_data())
+            if self.store.random_field:
+                data.setdefault(self.store.random_field, random.random())
             r = self.store.collection.insert_one(data)
+            if refresh:
+                self.store.refresh_search_tokens({'_id': r.inserted_id})
             return response.Response(self.get_object(r.inserted_id))
 
         def patch(self, request, pk, *args, **kargs):
             return self.update(request, pk, *args, **kargs)
 
+        def get_batch_items(self):
+            from bson.errors import InvalidId
+            items = self.request.data
+            if not isinstance(items, list):
+                raise exceptions.ValidationError('expected a list of {_id, changes}')
+            rs = []
+            for i, a in enumerate(items):
+                if not isinstance(a, dict) or not isinstance(a.get('changes'), dict) or not a.get('_id'):
+                    raise exceptions.ValidationError({i: 'expected {_id, changes}'})
+                try:
+                    rs.append((ObjectId(mongo_id_value(a['_id']) or a['_id']), a['changes'], bool(a.get('upsert'))))
+                except (InvalidId, TypeError):
+                    raise exceptions.ValidationError({i: 'invalid _id'})
+            return rs
+
+        @decorators.action(['patch', 'post'], detail=False)
+        def batch(self, request, *args, **kargs):
+            """
+            批量修改: 请求体为 [{_id, changes, upsert?}], 一次bulk_write写入, 一次$in取回,
+            mongo_batch_posted发送一次; mongo_posted有接收者时才逐条发送.
+            写入失败或取不到的条目不发信号, created按条目是否新插入给出(mongo_batch_posted里为与instances同序的列表);
+            errors只返回 {index, code, errmsg}
+            """
+            from pymongo import UpdateOne
+            items = self.get_batch_items()
+            if not items:
+                return response.Response(dict(matched=0, upserted=0, modified=0, errors=[], results=[]))
+            ops = []
+            refresh = []
+            for id, changes, upsert in items:
+                changes, rf = self.store.add_search_tokens(changes)
+                if rf:
+                    refresh.append(id)
+                u = {'$set': changes}
+                ops.append(UpdateOne({'_id': id}, set_on_insert_random(u, self.store.random_field, changes) if upsert else u,
+                                     upsert=upsert))
+            r = self.store.bulk_write(ops)
+            if refresh:
+                self.store.refresh_search_tokens({'_id': {'$in': refresh}})
+            upserted = set(r.pop('upserted_ids').values())
+            failed = set([e['index'] for e in r['errors']])
+            r['errors'] = [dict(index=e['index'], code=e.get('code'), errmsg=e.get('errmsg')) for e in r['errors']]
+            ids = [id for id, changes, upsert in items]
+            instances = self.to_json(self.eval_foreign_keys_batch(self.store.get_many(ids)))
+            posted = [(instance, items[i][1], items[i][0] in upserted) for i, instance in enumerate(instances)
+                      if i not in failed and instance is not None]
+            if posted:
+                ps, updates, created = [list(a) for a in zip(*posted)]
+                mongo_batch_posted.send_robust(sender=type(self), instances=ps, updates=updates, created=created)
+                if mongo_posted.has_listeners(type(self)):
+                    for instance, update, c in posted:
+                        mongo_posted.send_robust(sender=type(self), instance=instance, update=update, created=c)
+            r['results'] = instances
+            return response.Response(r)
+
 
 
 